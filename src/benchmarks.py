@@ -0,0 +1,446 @@
+import json
+import logging
+import os
+import re
+import string
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from src.slackEventHandler import SlackEventHandler
+from src.str_utils import TextAnalysis
+from src.event_utils import EventContext
+from src.misc_utils import HomophoneIndex, load_homophones
+from src import reading_utils
+from src.replay import FakeSlackClient
+from src.word_utils import ProfanityMatcher
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+
+SAMPLE_EVENT = {
+    'type': 'message',
+    'channel': 'D0BENCH01',
+    'user': 'U0BENCH01',
+    'text': 'I think their going to meet us over there at the sail on Sunday, right?',
+    'ts': '1520000000.000100'
+}
+
+
+class _NoopHandler(SlackEventHandler):
+    """
+    SlackEventHandler whose utilities do nothing, so only the dispatch itself is measured
+    """
+
+    def random_reply(self, sc, event, *args):
+        pass
+
+    def mark_read(self, sc, event, *args):
+        pass
+
+    def someones_talking_about_you(self, sc, event, *args):
+        pass
+
+    def magic_eight(self, sc, event, *args):
+        pass
+
+    def homophone_suggest(self, sc, event, *args):
+        pass
+
+    def reading_level(self, sc, event, *args):
+        pass
+
+    def sing_to_me(self, sc, event, *args):
+        pass
+
+    def clean_your_mouth_with_soap(self, sc, event, *args):
+        pass
+
+
+def report(name, seconds, n):
+    """
+    Logs the per-call cost of a timed benchmark
+
+    :param name: (str) name of the measured case
+    :param seconds: (float) total time for n calls
+    :param n: (int) number of calls
+    :return: (float) microseconds per call
+    """
+    per_call = seconds / n * 1e6
+    logger.info("{name:<40} {us:>10.2f} us/call {r:>12.0f} calls/sec".format(name=name, us=per_call, r=n / seconds))
+    return per_call
+
+
+def bench_dispatch(n=100000):
+    """
+    Compares the old eval()-per-flag dispatch against iterating the prebuilt handler tuple
+
+    :param n: (int) number of events to dispatch
+    :return: None
+    """
+    seh = _NoopHandler('xoxb-benchmark', users=[], stay_channel='benchmark', bad_words=['benchmark'])
+    for flg in seh.get_util_flag_choices():
+        seh.update_flag(flg, True)
+    sc, event, msg_type, all_users = None, SAMPLE_EVENT, 'IM', []
+    # names visible to the eval'd line, as the method locals were in the old begin()
+    namespace = {'self': seh, 'sc': sc, 'event': event, 'msg_type': msg_type, 'all_users': all_users}
+
+    def eval_dispatch():
+        for flg in seh.handler_flags:
+            if seh.handler_flags[flg] and flg != 'random_gif_flg' and flg != 'set_typing_flg':
+                eval('self.{f}(sc, event, msg_type, all_users)'.format(f=flg.replace('_flg', '')), namespace)
+
+    def registry_dispatch():
+        ctx = EventContext(seh, sc, event)
+        for handler in seh.handlers:
+            handler(sc, event, ctx)
+
+    before = report('dispatch: eval per flag', timeit.timeit(eval_dispatch, number=n), n)
+    after = report('dispatch: prebuilt handler tuple', timeit.timeit(registry_dispatch, number=n), n)
+    logger.info("speedup: {x:.1f}x".format(x=before / after))
+
+
+def _old_strip_punctuation(s):
+    for ch in string.punctuation:
+        s = s.strip(ch)
+    return s
+
+
+def bench_text_analysis(n=20000, users=200):
+    """
+    Compares each utility deriving its own lowercased text and tokens against one shared TextAnalysis per event.
+    Covers homophone_suggest, reading_level, clean_your_mouth_with_soap and a per-user lowercase in
+    someones_talking_about_you, as the utilities did before the shared pass
+
+    :param n: (int) number of events
+    :param users: (int) number of users the old someones_talking_about_you lowercased the text for
+    :return: None
+    """
+    # flat dict of every homophone, as looked up before the homophone index
+    homophones = dict.fromkeys(load_homophones())
+    bad_words = {'darn', 'heck'}
+    event = SAMPLE_EVENT
+
+    def per_utility():
+        [_old_strip_punctuation(word) for word in event['text'].lower().split(' ')
+         if _old_strip_punctuation(word) in homophones.keys()]
+        text = event['text'].lower()
+        len(re.findall(r'[!?\.]', text))
+        text.split()
+        any(word in bad_words for word in event['text'].lower().split())
+        for _ in range(users):
+            event['text'].lower()
+
+    def shared():
+        text = TextAnalysis(event)
+        [word for word in text.tokens if word in homophones]
+        len(re.findall(r'[!?\.]', text.lower))
+        text.words
+        any(word in bad_words for word in text.words)
+        text.lower
+
+    before = report('text: derived per utility', timeit.timeit(per_utility, number=n), n)
+    after = report('text: shared TextAnalysis', timeit.timeit(shared, number=n), n)
+    logger.info("saved {us:.2f} us per message ({x:.1f}x)".format(us=before - after, x=before / after))
+
+
+def _old_reading_level(text, min_words):
+    text = text.lower()
+    sentences = len(re.findall(r'[!?\.]', text))
+    if sentences == 0:
+        sentences = 1
+    words = text.split()
+    if len(words) < min_words:
+        return float('nan')
+    syllables = sum([len(re.findall(r'[aeiouy]+', x.rstrip('e'))) for x in words])
+    return 0.39*(len(words)/sentences) + 11.8*(syllables/len(words)) - 15.59
+
+
+def bench_reading_level(n=20000, min_words=10):
+    """
+    Compares scoring messages one at a time with per-word regexes against the batch grade_levels,
+    and checks both give the same grade levels
+
+    :param n: (int) number of texts to score
+    :param min_words: (int) minimum number of words needed for a score
+    :return: None
+    """
+    base = [SAMPLE_EVENT['text'],
+            'Short one.',
+            'The quick brown fox jumps over the lazy dog! Then it naps. Does anyone care? Nobody does, frankly.',
+            'Notwithstanding the aforementioned considerations, the committee unanimously recommended '
+            'reconsidering the organisational restructuring proposal immediately.']
+    texts = [base[i % len(base)] for i in range(n)]
+
+    start = timeit.default_timer()
+    old = [_old_reading_level(text, min_words) for text in texts]
+    before = report('reading level: per message', timeit.default_timer() - start, n)
+
+    start = timeit.default_timer()
+    new = reading_utils.grade_levels(texts, min_words=min_words)
+    after = report('reading level: batch grade_levels', timeit.default_timer() - start, n)
+
+    mismatches = sum(1 for a, b in zip(old, new) if not (a == b or (a != a and b != b)))
+    logger.info("speedup: {x:.1f}x, mismatches: {m}".format(x=before / after, m=mismatches))
+
+
+class _SlowGifHandler(SlackEventHandler):
+    """
+    SlackEventHandler whose magic_eight waits as long as a Giphy search would
+    """
+
+    latency = 0.05
+
+    def magic_eight(self, sc, event, *args):
+        time.sleep(self.latency)
+
+
+def bench_io_pool(n=40, channels=4, latency=0.05, io_workers=4):
+    """
+    Compares how long the read loop is blocked by a batch of events when a slow network utility runs inline and
+    when it runs on the utility pool
+
+    :param n: (int) number of events in the batch
+    :param channels: (int) number of channels the events are spread over
+    :param latency: (float) seconds each slow utility call takes
+    :param io_workers: (int) threads in the utility pool
+    :return: None
+    """
+    events = [dict(SAMPLE_EVENT, channel='D0BENCH{c:02d}'.format(c=i % channels), ts='{i}.0'.format(i=i))
+              for i in range(n)]
+    _SlowGifHandler.latency = latency
+    for workers in (0, io_workers):
+        seh = _SlowGifHandler('xoxb-benchmark', users=['U0BENCH01'], stay_channel='benchmark', run_level='All',
+                              handler_flags={'magic_eight_flg': True, 'homophone_suggest_flg': True},
+                              io_workers=workers)
+        sc = FakeSlackClient([])
+        start = timeit.default_timer()
+        seh.handle_events(sc, events)
+        blocked = timeit.default_timer() - start
+        if seh.io is not None:
+            seh.io.join()
+        done = timeit.default_timer() - start
+        logger.info("{m:<20} read loop blocked {b:>8.3f}s, all utilities done after {d:>8.3f}s".format(
+            m='pool of {w}'.format(w=workers) if workers else 'inline', b=blocked, d=done))
+
+
+# flag configurations measured by bench_startup, and modules imported up front to reproduce eager loading
+STARTUP_CONFIGS = [
+    ('no utilities, eager imports', {}, ['giphypop', 'requests', 'lxml.html']),
+    ('no utilities', {}, []),
+    ('text only', {'homophone_suggest_flg': True, 'reading_level_flg': True}, []),
+    ('soap', {'clean_your_mouth_with_soap_flg': True}, []),
+    ('gifs', {'magic_eight_flg': True, 'random_reply_flg': True, 'random_gif_flg': True}, []),
+    ('sing', {'sing_to_me_flg': True}, []),
+    ('everything', dict((flg, True) for flg in SlackEventHandler.DEPENDENCIES), [])
+]
+
+_STARTUP_SCRIPT = '''
+import importlib, json, resource, sys, time
+start = time.time()
+for module in {eager!r}:
+    importlib.import_module(module)
+from src.slackEventHandler import SlackEventHandler
+seh = SlackEventHandler('xoxb-benchmark', handler_flags={flags!r}, users=[], stay_channel='benchmark',
+                        bad_words=['benchmark'])
+seh.load_dependencies(seh.handler_flags)
+print(json.dumps({{'seconds': time.time() - start,
+                  'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'modules': [m for m in ('slackclient', 'giphypop', 'requests', 'lxml') if m in sys.modules]}}))
+'''
+
+
+def bench_startup(repeat=5):
+    """
+    Measures import time, construction time and peak RSS of a fresh process creating a handler, for several flag
+    configurations. Each configuration runs in its own interpreter so nothing is already imported.
+
+    :param repeat: (int) number of runs per configuration; the fastest is reported
+    :return: None
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name, flags, eager in STARTUP_CONFIGS:
+        script = _STARTUP_SCRIPT.format(eager=eager, flags=flags)
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', script], cwd=root, stderr=subprocess.DEVNULL)
+            runs.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+        best = min(runs, key=lambda run: run['seconds'])
+        logger.info("{n:<30} {t:>8.1f} ms {r:>8.1f} MB  loaded: {m}".format(
+            n=name, t=best['seconds'] * 1000, r=best['rss_kb'] / 1024.0, m=', '.join(best['modules'])))
+
+
+def _homophone_file(path, sets, seed=7):
+    """
+    Writes a synthetic homophone dictionary, with a multi-word entry in every tenth set and a hyphenated one in every
+    seventh
+
+    :param path: (str) file to write
+    :param sets: (int) number of sets
+    :param seed: (int) random seed
+    :return: (list) every entry written
+    """
+    rng = random.Random(seed)
+    entries = []
+    with open(path, 'w') as f:
+        for i in range(sets):
+            members = ['w{i}x{m}'.format(i=i, m=m) for m in range(rng.randint(2, 4))]
+            if i % 10 == 0:
+                members.append('w{i} phrase'.format(i=i))
+            if i % 7 == 0:
+                members.append('w{i}-'.format(i=i))
+            entries += members
+            f.write(', '.join(members) + '\n')
+    return entries
+
+
+def bench_homophones(sets=5000, n=20000):
+    """
+    Measures bulk loading of a large homophone file into HomophoneIndex (time and memory) and the cost of finding
+    homophones in a message, against the old flat dict lookup over stripped tokens. The flat dict only finds single
+    word entries and one alternative each, so expect the index to be somewhat slower per message
+
+    :param sets: (int) number of homophone sets in the file
+    :param n: (int) number of messages searched
+    :return: None
+    """
+    with tempfile.NamedTemporaryFile(suffix='.txt', delete=False) as f:
+        path = f.name
+    try:
+        entries = _homophone_file(path, sets)
+        start = timeit.default_timer()
+        index = HomophoneIndex()
+        index.load_file(path)
+        seconds = timeit.default_timer() - start
+
+        # loaded again under tracemalloc, which slows loading down
+        tracemalloc.start()
+        traced = HomophoneIndex()
+        traced.load_file(path)
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del traced
+        logger.info("load {s} sets / {e} entries: {t:.1f} ms, {m:.2f} MB held, {p:.2f} MB peak".format(
+            s=len(index.sets), e=len(index), t=seconds * 1000, m=size / 1e6, p=peak / 1e6))
+    finally:
+        os.remove(path)
+
+    # old flat dict: one alternative per single-token key
+    flat = {}
+    for members in index.sets.values():
+        for a, b in zip(members, members[1:] + members[:1]):
+            flat[a] = b
+    rng = random.Random(11)
+    single = [entry for entry in entries if ' ' not in entry and '-' not in entry]
+    messages = []
+    for i in range(200):
+        words = SAMPLE_EVENT['text'].lower().split()
+        if i % 2:
+            words.insert(rng.randint(0, len(words)), rng.choice(single))
+        messages.append(' '.join(words))
+
+    def old_lookup():
+        for message in messages:
+            text = TextAnalysis({'text': message})
+            if flat.keys().isdisjoint(text.tokens):
+                continue
+            [(word, flat[word]) for word in text.tokens if word in flat]
+
+    def index_lookup():
+        for message in messages:
+            index.find_in_tokens(TextAnalysis({'text': message}).tokens)
+
+    number = max(n // len(messages), 1)
+    before = report('homophones: flat dict over tokens', timeit.timeit(old_lookup, number=number),
+                    number * len(messages))
+    after = report('homophones: trie index', timeit.timeit(index_lookup, number=number), number * len(messages))
+    logger.info("ratio: {x:.2f}x".format(x=before / after))
+
+
+def _obfuscate(word, rng):
+    """
+    :param word: (str) word to disguise
+    :param rng: (random.Random) source of the disguise
+    :return: (str) word with look-alike characters, separators, spaces or repeated letters
+    """
+    style = rng.randint(0, 3)
+    if style == 0:
+        return word.replace('a', '4').replace('e', '3').replace('o', '0').replace('s', '$')
+    elif style == 1:
+        return '.'.join(word.upper())
+    elif style == 2:
+        return ' '.join(word)
+    i = rng.randrange(len(word))
+    return word[:i] + word[i] * rng.randint(2, 5) + word[i:]
+
+
+def bench_profanity(words=400, n=20000):
+    """
+    Compares the old bad word check, a set lookup over the message's words, with ProfanityMatcher on clean messages,
+    messages with a plain bad word and messages with an obfuscated one, and counts what each catches
+
+    :param words: (int) size of the bad word list
+    :param n: (int) number of messages checked
+    :return: None
+    """
+    rng = random.Random(5)
+    bad_words = set(['darn', 'heck', 'frick', 'dang', 'bloody', 'bugger'])
+    while len(bad_words) < words:
+        bad_words.add(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 8))))
+    listed = sorted(bad_words)
+
+    start = timeit.default_timer()
+    matcher = ProfanityMatcher(bad_words)
+    seconds = timeit.default_timer() - start
+    logger.info("build matcher for {w} words: {t:.1f} ms".format(w=len(matcher), t=seconds * 1000))
+
+    corpus = {'clean': [], 'plain': [], 'obfuscated': []}
+    for i in range(100):
+        tokens = SAMPLE_EVENT['text'].split()
+        corpus['clean'].append(' '.join(tokens))
+        at = rng.randint(0, len(tokens))
+        word = rng.choice(listed)
+        corpus['plain'].append(' '.join(tokens[:at] + [word] + tokens[at:]))
+        corpus['obfuscated'].append(' '.join(tokens[:at] + [_obfuscate(word, rng)] + tokens[at:]))
+
+    number = max(n // 100, 1)
+    for kind in ('clean', 'plain', 'obfuscated'):
+        messages = corpus[kind]
+
+        def set_lookup():
+            return sum(1 for message in messages
+                       if any(word in bad_words for word in TextAnalysis({'text': message}).words))
+
+        def matcher_lookup():
+            return sum(1 for message in messages if matcher.search(message))
+
+        before = report('profanity {k}: set lookup'.format(k=kind), timeit.timeit(set_lookup, number=number),
+                        number * len(messages))
+        after = report('profanity {k}: matcher'.format(k=kind), timeit.timeit(matcher_lookup, number=number),
+                       number * len(messages))
+        logger.info("{k}: caught {o} / {m} with the set lookup, {f} / {m} with the matcher, {x:.1f}x the time".format(
+            k=kind, o=set_lookup(), f=matcher_lookup(), m=len(messages), x=after / before))
+
+
+BENCHMARKS = {
+    'dispatch': bench_dispatch,
+    'text_analysis': bench_text_analysis,
+    'reading_level': bench_reading_level,
+    'io_pool': bench_io_pool,
+    'startup': bench_startup,
+    'homophones': bench_homophones,
+    'profanity': bench_profanity
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        logger.info("== {n}".format(n=name))
+        BENCHMARKS[name]()
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.useless_slack_utils')
+
+
+class TTLCache:
+    """
+    Small in-memory cache with LRU eviction and an optional time-to-live per entry.
+    Safe to share between the event loop and the utility threads.
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        """
+        :param max_size: (int) maximum number of entries kept; the least recently used entry is evicted first
+        :param ttl: (float) seconds an entry stays valid; None if entries never expire
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for key, or default if it is missing or expired
+
+        :param key: key to look up
+        :param default: value to return on a miss
+        :return: cached value or default
+        """
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value under key, evicting the least recently used entries if the cache is full
+
+        :param key: key to store
+        :param value: value to store
+        :param ttl: (float) override of the cache ttl for this entry
+        :return: None
+        """
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl is not None else None)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        Removes key from the cache
+
+        :param key: key to remove
+        :param default: value to return if key is not cached
+        :return: removed value or default
+        """
+        with self._lock:
+            try:
+                return self._data.pop(key)[0]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def dump(self):
+        """
+        :return: (list) [key, value, expiry time] of every live entry, least recently used first
+        """
+        now = time.time()
+        with self._lock:
+            return [[key, value, expires] for key, (value, expires) in self._data.items()
+                    if expires is None or expires >= now]
+
+    def restore(self, entries):
+        """
+        Adds entries from dump(), keeping their original expiry times. Expired entries are skipped.
+
+        :param entries: (list) [key, value, expiry time] entries
+        :return: (int) number of entries restored
+        """
+        now = time.time()
+        count = 0
+        with self._lock:
+            for key, value, expires in entries:
+                if expires is not None and expires < now:
+                    continue
+                self._data[key] = (value, expires)
+                self._data.move_to_end(key)
+                count += 1
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return count
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskCache:
+    """
+    JSON-serialisable values cached on local disk, one file per key, with an optional expiry.
+    Survives restarts and can be shared by several processes using the same directory.
+    Expired entries stay available to get(allow_expired=True) for keep_expired seconds, then their files are deleted
+    when read, or by the prune() that set() runs every prune_interval seconds.
+    """
+
+    def __init__(self, path, ttl=None, keep_expired=7 * 24 * 60 * 60, prune_interval=60 * 60):
+        """
+        :param path: (str) directory the cache files are written to; created if missing
+        :param ttl: (float) default seconds an entry stays valid; None if entries never expire
+        :param keep_expired: (float) seconds an expired entry is kept as a fallback before its file is deleted
+        :param prune_interval: (float) seconds between scans of the directory for files to delete
+        """
+        self.path = path
+        self.ttl = ttl
+        self.keep_expired = keep_expired
+        self.prune_interval = prune_interval
+        self._next_prune = 0
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key, default=None, allow_expired=False):
+        """
+        Returns the cached value for key, or default if it is missing, expired or unreadable
+
+        :param key: (str) key to look up
+        :param default: value to return on a miss
+        :param allow_expired: (bool) if True, return an expired value instead of default
+        :return: cached value or default
+        """
+        try:
+            with open(self._file(key)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return default
+
+        if entry.get('key') != key:
+            return default
+        if not allow_expired and entry['expires'] is not None and entry['expires'] < time.time():
+            if self._discarded(entry['expires']):
+                self._remove(self._file(key))
+            return default
+        return entry['value']
+
+    def _discarded(self, expires, now=None):
+        # True once an entry has been expired for longer than keep_expired
+        return expires is not None and expires + self.keep_expired < (time.time() if now is None else now)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            # already removed, i.e. by another process sharing the directory
+            pass
+
+    def prune(self):
+        """
+        Deletes the files of entries that have been expired for longer than keep_expired
+
+        :return: (int) number of files deleted
+        """
+        now = time.time()
+        self._next_prune = now + self.prune_interval
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return 0
+
+        count = 0
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                with open(path) as f:
+                    expires = json.load(f).get('expires')
+            except (IOError, OSError, ValueError, AttributeError):
+                continue
+            if self._discarded(expires, now):
+                self._remove(path)
+                count += 1
+        if count:
+            logger.debug("Pruned {n} expired cache entries from {p}.".format(n=count, p=self.path))
+        return count
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value under key. The file is replaced atomically, so readers never see a partial entry.
+
+        :param key: (str) key to store
+        :param value: JSON-serialisable value
+        :param ttl: (float) override of the cache ttl for this entry
+        :return: None
+        """
+        ttl = self.ttl if ttl is None else ttl
+        entry = {'key': key, 'expires': time.time() + ttl if ttl is not None else None, 'value': value}
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, self._file(key))
+        except (IOError, OSError) as e:
+            logger.error("Could not write cache entry for {k}: {e}".format(k=key, e=e))
+            return
+        if time.time() >= self._next_prune:
+            self.prune()
@@ -0,0 +1,129 @@
+import logging
+
+from src.str_utils import TextAnalysis
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+# message subtypes that carry a user's text; edits, deletions, joins and bot posts are left out
+MESSAGE_SUBTYPES = (None, 'me_message', 'thread_broadcast', 'file_share')
+# subscription to every subtype of an event type
+ANY_SUBTYPE = '*'
+
+
+def subscribe(event_type='message', subtypes=MESSAGE_SUBTYPES):
+    """
+    Declares which RTM events a utility handles. Can be stacked to subscribe to several event types.
+    Utilities without a declaration receive user messages, as if decorated with @subscribe().
+
+    :param event_type: (str) RTM event type, i.e. message or reaction_added
+    :param subtypes: subtypes of event_type to handle, None standing for events without a subtype;
+        ANY_SUBTYPE for all of them
+    :return: decorator
+    """
+    def decorator(fn):
+        subscriptions = dict(getattr(fn, 'subscriptions', {}))
+        subscriptions[event_type] = subtypes if subtypes == ANY_SUBTYPE else frozenset(subtypes)
+        fn.subscriptions = subscriptions
+        return fn
+    return decorator
+
+
+def subscriptions_of(handler):
+    """
+    :param handler: utility method
+    :return: (dict) event type to subtypes handled by the utility
+    """
+    subscriptions = getattr(handler, 'subscriptions', None)
+    if subscriptions is None:
+        subscriptions = {'message': frozenset(MESSAGE_SUBTYPES)}
+    return subscriptions
+
+
+class EventRouter:
+    """
+    Sends each event only to the utilities subscribed to its type and subtype.
+    The subscribers of each (type, subtype) pair are resolved once and then looked up with a single dict access.
+    """
+
+    def __init__(self, handlers=()):
+        """
+        :param handlers: utilities, in the order they should run
+        """
+        self.handlers = tuple(handlers)
+        self._routes = {}
+
+    def subscribers(self, event_type, subtype=None):
+        """
+        :param event_type: (str) RTM event type
+        :param subtype: (str) event subtype, or None
+        :return: (tuple) utilities subscribed to the event type and subtype
+        """
+        key = (event_type, subtype)
+        route = self._routes.get(key)
+        if route is None:
+            route = []
+            for handler in self.handlers:
+                subtypes = subscriptions_of(handler).get(event_type)
+                if subtypes is not None and (subtypes == ANY_SUBTYPE or subtype in subtypes):
+                    route.append(handler)
+            route = self._routes[key] = tuple(route)
+        return route
+
+    def route(self, event):
+        """
+        :param event: (dict) RTM event
+        :return: (tuple) utilities that should handle the event; empty if nobody subscribes to it
+        """
+        return self.subscribers(event.get('type'), event.get('subtype'))
+
+
+class EventContext:
+    """
+    Facts about one event that utilities may need, each computed on first access and shared by every utility
+    handling the event. A configuration whose utilities never read msg_type or members makes no API call for them.
+    """
+
+    __slots__ = ('handler', 'sc', 'event', '_msg_type', '_text', '_members')
+
+    def __init__(self, handler, sc, event):
+        """
+        :param handler: (SlackEventHandler) handler whose caches answer the lookups
+        :param sc: SlackClient used to connect to server
+        :param event: (dict) message event
+        """
+        self.handler = handler
+        self.sc = sc
+        self.event = event
+        self._msg_type = None
+        self._text = None
+        self._members = None
+
+    @property
+    def msg_type(self):
+        """
+        :return: type of message (Public, Private or IM), looked up through the channel type cache
+        """
+        if self._msg_type is None:
+            self._msg_type = self.handler.get_msg_type(self.sc, self.event)
+        return self._msg_type
+
+    @property
+    def text(self):
+        """
+        :return: (TextAnalysis) shared analysis of the message text
+        """
+        if self._text is None:
+            self._text = TextAnalysis(self.event)
+        return self._text
+
+    @property
+    def members(self):
+        """
+        :return: (set) user IDs of the members of the event's channel
+        :raises SlackApiException: if the members could not be fetched
+        """
+        if self._members is None:
+            self._members = self.handler.memberships.members(self.sc, self.event['channel'])
+        return self._members
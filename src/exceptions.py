@@ -31,4 +31,21 @@ class NoArgumentsPassedException(Exception):
     """
 
     def __init__(self,message):
-        self.message = message
\ No newline at end of file
+        self.message = message
+
+class SlackApiException(Exception):
+    """
+    Use if a Slack Web API call does not return ok
+    """
+
+    def __init__(self, method, error, *args):
+        self.message = "Slack API method {m} failed: {e}".format(m=method, e=error)
+
+
+class RequestFailedException(Exception):
+    """
+    Use if a request could not be completed, i.e. on a timeout or connection error
+    """
+
+    def __init__(self, url, error, *args):
+        self.message = "Request to {u} failed: {e}".format(u=url, e=error)
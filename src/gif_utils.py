@@ -0,0 +1,121 @@
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from src.cache_utils import TTLCache
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+class GifResolver:
+    """
+    Resolves search terms to Giphy URLs through a bounded TTL cache, optionally backed by an on-disk cache that
+    other processes can share.
+    Only as many results as a caller needs are fetched, and known queries can be prefetched in the background.
+    """
+
+    def __init__(self, max_size=512, ttl=12 * 60 * 60, max_workers=4, disk_cache=None):
+        """
+        :param max_size: (int) maximum number of queries kept in the cache
+        :param ttl: (float) seconds before a query is searched again
+        :param max_workers: (int) number of parallel searches used by prefetch
+        :param disk_cache: (DiskCache) optional second level cache, checked before searching Giphy
+        """
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)
+        self.ttl = ttl
+        self.disk_cache = disk_cache
+        self.max_workers = max_workers
+        self._giphy = None
+        self._lock = threading.Lock()
+
+    @property
+    def giphy(self):
+        if self._giphy is None:
+            # imported on first search, so handlers without gif utilities never load giphypop
+            import giphypop
+            self._giphy = giphypop.Giphy()
+        return self._giphy
+
+    def search(self, query, limit=1):
+        """
+        Returns up to limit gif URLs for a query, searching Giphy only if the cache does not hold enough of them
+
+        :param query: (str) search term
+        :param limit: (int) number of results needed
+        :return: (list) gif URLs, possibly fewer than limit if Giphy has fewer results
+        """
+        with self._lock:
+            cached = self.cache.get(query)
+        if cached is None and self.disk_cache is not None:
+            cached = self.disk_cache.get('giphy:' + query)
+            if cached is not None:
+                with self._lock:
+                    self.cache.set(query, cached)
+        if cached is not None and (len(cached[0]) >= limit or cached[1]):
+            return cached[0][:limit]
+
+        results = ['{v}'.format(v=gif) for gif in islice(self.giphy.search(query, limit=limit), limit)]
+        # remember whether Giphy ran out, so a short result list is not searched again
+        entry = (results, len(results) < limit)
+        with self._lock:
+            self.cache.set(query, entry)
+        if self.disk_cache is not None:
+            self.disk_cache.set('giphy:' + query, entry, ttl=self.ttl)
+        return results
+
+    def dump(self):
+        """
+        :return: (list) cached queries and their results, JSON serialisable, for restore()
+        """
+        with self._lock:
+            return self.cache.dump()
+
+    def restore(self, entries):
+        """
+        Adds cached queries from a previous dump(); expired queries are skipped
+
+        :param entries: (list) result of dump()
+        :return: (int) number of queries restored
+        """
+        with self._lock:
+            return self.cache.restore(entries)
+
+    def first(self, query):
+        """
+        :param query: (str) search term
+        :return: (str) top gif URL for the query, or None if there are no results
+        """
+        results = self.search(query, limit=1)
+        return results[0] if results else None
+
+    def choice(self, query, top=10):
+        """
+        :param query: (str) search term
+        :param top: (int) number of top results to choose from
+        :return: (str) random gif URL out of the top results for the query, or None if there are no results
+        """
+        results = self.search(query, limit=top)
+        return random.choice(results) if results else None
+
+    def prefetch(self, queries, limit=1):
+        """
+        Searches for every query in parallel in the background, so later lookups are served from the cache
+
+        :param queries: (list) search terms
+        :param limit: (int) number of results to fetch for each query
+        :return: (list) futures that complete as each query is fetched
+        """
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = [executor.submit(self._prefetch_one, query, limit) for query in queries]
+        executor.shutdown(wait=False)
+        return futures
+
+    def _prefetch_one(self, query, limit):
+        try:
+            self.search(query, limit=limit)
+        except Exception as e:
+            logger.error("Could not prefetch gifs for {q}: {e}".format(q=query, e=e))
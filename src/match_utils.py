@@ -0,0 +1,151 @@
+import logging
+from collections import deque
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+class AhoCorasick:
+    """
+    Multi-pattern string matcher. Finds every occurrence of every pattern in a single pass over the text.
+
+    Patterns can be added and removed at any time. Adding or removing only touches the trie;
+    the failure links are rebuilt lazily, once, on the next search after a change.
+    """
+
+    def __init__(self, patterns=None):
+        """
+        :param patterns: (dict) optional initial patterns, mapping each pattern to a value or an iterable of values
+        """
+        self._goto = [{}]
+        self._fail = [0]
+        self._depth = [0]
+        self._values = [set()]
+        self._out = [-1]
+        self._built = True
+
+        if patterns:
+            for pattern in patterns:
+                values = patterns[pattern]
+                if isinstance(values, (set, list, tuple, frozenset)):
+                    for value in values:
+                        self.add(pattern, value)
+                else:
+                    self.add(pattern, values)
+
+    def __len__(self):
+        return sum(1 for values in self._values if values)
+
+    def add(self, pattern, value=None):
+        """
+        Adds a pattern to the automaton
+
+        :param pattern: (str) pattern to find
+        :param value: value reported when the pattern is found; defaults to the pattern itself
+        :return: None
+        """
+        if not pattern:
+            return
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._depth.append(self._depth[node] + 1)
+                self._values.append(set())
+                self._out.append(-1)
+                self._goto[node][ch] = nxt
+                self._built = False
+            node = nxt
+        if not self._values[node]:
+            self._built = False
+        self._values[node].add(pattern if value is None else value)
+
+    def remove(self, pattern, value=None):
+        """
+        Removes a value from a pattern. The pattern stops matching once it has no values left.
+
+        :param pattern: (str) pattern to remove
+        :param value: value to remove; defaults to the pattern itself
+        :return: (bool) True if the value was found and removed
+        """
+        node = self._find(pattern)
+        if node is None:
+            return False
+        values = self._values[node]
+        value = pattern if value is None else value
+        if value not in values:
+            return False
+        values.discard(value)
+        if not values:
+            self._built = False
+        return True
+
+    def _find(self, pattern):
+        node = 0
+        for ch in pattern:
+            node = self._goto[node].get(ch)
+            if node is None:
+                return None
+        return node
+
+    def build(self):
+        """
+        Computes the failure and output links with a breadth first pass over the trie
+
+        :return: None
+        """
+        goto, fail, values, out = self._goto, self._fail, self._values, self._out
+        queue = deque()
+        for child in goto[0].values():
+            fail[child] = 0
+            out[child] = -1
+            queue.append(child)
+
+        while queue:
+            node = queue.popleft()
+            for ch, child in goto[node].items():
+                state = fail[node]
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                f = goto[state].get(ch, 0)
+                fail[child] = f if f != child else 0
+                out[child] = fail[child] if values[fail[child]] else out[fail[child]]
+                queue.append(child)
+
+        self._built = True
+
+    def iter_matches(self, text):
+        """
+        Finds every pattern occurrence in the text
+
+        :param text: (str) text to search
+        :return: generator of (start, end, value) tuples, with text[start:end] equal to the matched pattern
+        """
+        if not self._built:
+            self.build()
+
+        goto, fail, depth, values, out = self._goto, self._fail, self._depth, self._values, self._out
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+
+            node = state if values[state] else out[state]
+            while node > 0:
+                for value in values[node]:
+                    yield i + 1 - depth[node], i + 1, value
+                node = out[node]
+
+    def find_all(self, text):
+        """
+        Returns the values of every pattern found in the text
+
+        :param text: (str) text to search
+        :return: (set) values of matched patterns
+        """
+        return set(value for _, _, value in self.iter_matches(text))
@@ -0,0 +1,295 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+class MessageScheduler:
+    """
+    Heap of delayed outbound messages.
+    Utilities schedule messages instead of sleeping, and the event loop sends whatever is due between reads.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, channel, message, delay=0.0):
+        """
+        Queues a message to be sent after a delay
+
+        :param channel: (str) channel to send to
+        :param message: (str) message text
+        :param delay: (float) seconds from now
+        :return: None
+        """
+        with self._lock:
+            heapq.heappush(self._heap, (time.time() + delay, next(self._seq), channel, message))
+
+    def schedule_sequence(self, channel, messages, interval=1.0, delay=0.0):
+        """
+        Queues several messages to be sent one after the other, interval seconds apart
+
+        :param channel: (str) channel to send to
+        :param messages: (list) message texts, in order
+        :param interval: (float) seconds between messages
+        :param delay: (float) seconds from now until the first message
+        :return: (float) seconds from now until the last message is sent
+        """
+        start = time.time() + delay
+        with self._lock:
+            for i, message in enumerate(messages):
+                heapq.heappush(self._heap, (start + i * interval, next(self._seq), channel, message))
+        return delay + max(len(messages) - 1, 0) * interval
+
+    def next_due(self):
+        """
+        :return: (float) seconds until the next message is due (0 if overdue), or None if nothing is scheduled
+        """
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(self._heap[0][0] - time.time(), 0.0)
+
+    def run_due(self, send):
+        """
+        Sends every message that is due
+
+        :param send: callable taking (channel, message), i.e. SlackClient.rtm_send_message
+        :return: (int) number of messages sent
+        """
+        due = []
+        now = time.time()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+
+        for i, (_, _, channel, message) in enumerate(due):
+            try:
+                send(channel, message)
+            except Exception:
+                # keep what was not sent, i.e. when the connection dropped, for the next run
+                with self._lock:
+                    for entry in due[i:]:
+                        heapq.heappush(self._heap, entry)
+                raise
+        return len(due)
+
+    def dump(self):
+        """
+        :return: (list) [due time, channel, message] of every scheduled message, in order, for restore()
+        """
+        with self._lock:
+            return [[due, channel, message] for due, _, channel, message in sorted(self._heap)]
+
+    def restore(self, entries):
+        """
+        Schedules messages from dump() at their original times; messages already due are sent on the next run
+
+        :param entries: (list) [due time, channel, message] entries
+        :return: (int) number of messages restored
+        """
+        with self._lock:
+            for due, channel, message in entries:
+                heapq.heappush(self._heap, (due, next(self._seq), channel, message))
+        return len(entries)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: allows rate operations per second with bursts of up to capacity
+    """
+
+    def __init__(self, rate=1.0, capacity=1):
+        """
+        :param rate: (float) tokens added per second
+        :param capacity: (int) maximum number of tokens held
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now=None):
+        """
+        :param now: (float) current time; defaults to time.time()
+        :return: (bool) True if a token was available and has been taken
+        """
+        self._refill(time.time() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now=None):
+        """
+        :param now: (float) current time; defaults to time.time()
+        :return: (float) seconds until a token is available
+        """
+        self._refill(time.time() if now is None else now)
+        return max(1 - self.tokens, 0) / self.rate
+
+    def is_full(self, now=None):
+        """
+        :param now: (float) current time; defaults to time.time()
+        :return: (bool) True if the bucket holds capacity tokens, so a new bucket would behave the same
+        """
+        self._refill(time.time() if now is None else now)
+        return self.tokens >= self.capacity
+
+
+class OutboundQueue:
+    """
+    Central queue for outbound messages, rate limited per channel with token buckets.
+    Messages for the same channel and the same event that are still waiting are coalesced into one post.
+    A channel's bucket is dropped once nothing is waiting for it and it has refilled, so only recently active
+    channels hold one.
+    """
+
+    def __init__(self, rate=1.0, burst=1, max_depth=1000, separator='\n'):
+        """
+        :param rate: (float) messages per second allowed for each channel
+        :param burst: (int) messages a channel may send back to back before being limited
+        :param max_depth: (int) maximum number of waiting messages; new messages are dropped once it is reached
+        :param separator: (str) text used to join coalesced messages
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_depth = max_depth
+        self.separator = separator
+        self.stats = {'queued': 0, 'sent': 0, 'coalesced': 0, 'dropped': 0}
+        self._channels = OrderedDict()
+        self._buckets = {}
+        self._depth = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._depth
+
+    def put(self, channel, message, key=None):
+        """
+        Queues a message
+
+        :param channel: (str) channel to send to
+        :param message: (str) message text
+        :param key: key of the event the message answers; waiting messages with the same channel and key are
+            merged. None if the message should never be merged
+        :return: (bool) False if the message was dropped because the queue is full
+        """
+        with self._lock:
+            pending = self._channels.get(channel)
+            if key is not None and pending:
+                for entry in pending:
+                    if entry[0] == key:
+                        entry[1] = entry[1] + self.separator + message
+                        self.stats['coalesced'] += 1
+                        return True
+
+            if self._depth >= self.max_depth:
+                self.stats['dropped'] += 1
+                logger.debug("Outbound queue full. Dropped message for {c}.".format(c=channel))
+                return False
+
+            if pending is None:
+                pending = self._channels[channel] = deque()
+            pending.append([key, message])
+            self._depth += 1
+            self.stats['queued'] += 1
+            return True
+
+    def flush(self, send):
+        """
+        Sends every waiting message its channel's rate limit allows, in order per channel
+
+        :param send: callable taking (channel, message), i.e. SlackClient.rtm_send_message
+        :return: (int) number of messages sent
+        """
+        ready = []
+        now = time.time()
+        with self._lock:
+            for channel in list(self._channels):
+                pending = self._channels[channel]
+                bucket = self._buckets.get(channel)
+                if bucket is None:
+                    bucket = self._buckets[channel] = TokenBucket(self.rate, self.burst)
+                while pending and bucket.take(now):
+                    ready.append((channel, pending.popleft()[1]))
+                if not pending:
+                    del self._channels[channel]
+            for channel in [channel for channel, bucket in self._buckets.items()
+                            if channel not in self._channels and bucket.is_full(now)]:
+                del self._buckets[channel]
+            self._depth -= len(ready)
+            self.stats['sent'] += len(ready)
+
+        for i, (channel, message) in enumerate(ready):
+            try:
+                send(channel, message)
+            except Exception:
+                self._requeue(ready[i:])
+                raise
+        return len(ready)
+
+    def _requeue(self, unsent):
+        # puts messages that could not be sent, i.e. when the connection dropped, back at the front of their channels
+        with self._lock:
+            for channel, message in reversed(unsent):
+                pending = self._channels.get(channel)
+                if pending is None:
+                    pending = self._channels[channel] = deque()
+                pending.appendleft([None, message])
+            self._depth += len(unsent)
+            self.stats['sent'] -= len(unsent)
+
+    def dump(self):
+        """
+        :return: (list) [channel, key, message] of every waiting message, in order per channel, for restore()
+        """
+        with self._lock:
+            return [[channel, key, message] for channel, pending in self._channels.items() for key, message in pending]
+
+    def restore(self, entries):
+        """
+        Queues messages from dump() again. Keys that a JSON round trip turned into lists are made tuples again,
+        so later replies to the same event still coalesce with them.
+
+        :param entries: (list) [channel, key, message] entries
+        :return: (int) number of messages queued
+        """
+        return sum(1 for channel, key, message in entries
+                   if self.put(channel, message, tuple(key) if isinstance(key, list) else key))
+
+    def next_ready(self):
+        """
+        :return: (float) seconds until a waiting message may be sent, or None if nothing is waiting
+        """
+        now = time.time()
+        with self._lock:
+            waits = [self._buckets[channel].wait_time(now) if channel in self._buckets else 0.0
+                     for channel in self._channels]
+        return min(waits) if waits else None
+
+    def get_stats(self):
+        """
+        :return: (dict) queue depth, number of channels waiting, and queued/sent/coalesced/dropped counters
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats['depth'] = self._depth
+            stats['channels_waiting'] = len(self._channels)
+        return stats
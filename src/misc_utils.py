@@ -1,104 +1,351 @@
 import logging
+import sys
+
+from src.str_utils import strip_punctuation, to_token
+from src import exceptions
 
 logger = logging.getLogger()
 logging.basicConfig()
 logger.setLevel(logging.DEBUG)
 
+DEFAULT_HOMOPHONES = {
+    "your": "you're",
+    "air": "heir",
+    "aisle": "isle",
+    "ante-": "anti-",
+    "eye": "I",
+    "bare": "bear",
+    "be": "bee",
+    "brake": "break",
+    "buy": "by",
+    "cell": "sell",
+    "cent": "scent",
+    "cereal": "serial",
+    "coarse": "course",
+    "complement": "compliment",
+    "dam": "damn",
+    "dear": "deer",
+    "die": "dye",
+    "fair": "fare",
+    "fir": "fur",
+    "flour": "flower",
+    "for": "four",
+    "hair": "hare",
+    "heal": "heel",
+    "hear": "here",
+    "him": "hymn",
+    "hole": "whole",
+    "hour": "our",
+    "idle": "idol",
+    "in": "inn",
+    "knight": "night",
+    "knot": "not",
+    "know": "no",
+    "made": "maid",
+    "mail": "male",
+    "meat": "meet",
+    "morning": "mourning",
+    "none": "nun",
+    "oar": "or",
+    "one": "won",
+    "pair": "pear",
+    "peace": "piece",
+    "plain": "plane",
+    "poor": "pour",
+    "pray": "prey",
+    "principal": "principle",
+    "profit": "prophet",
+    "real": "reel",
+    "right": "write",
+    "root": "route",
+    "sail": "sale",
+    "sea": "see",
+    "seam": "seem",
+    "sight": "site",
+    "sew": "so",
+    "shore": "sure",
+    "sole": "soul",
+    "some": "sum",
+    "son": "sun",
+    "stair": "stare",
+    "stationary": "stationery",
+    "steal": "steel",
+    "suite": "sweet",
+    "tail": "tale",
+    "their": "there",
+    "theyre": "there",
+    "there": "they're",
+    "to": "too",
+    "toe": "tow",
+    "waist": "waste",
+    "wait": "weight",
+    "way": "weigh",
+    "weak": "week",
+    "wear": "where",
+    "hay": "hey"
+}
+
+
+class HomophoneIndex:
+    """
+    Sets of homophones, i.e. {their, there, they're}, indexed in a token trie.
+    Messages are tokenised like TextAnalysis.tokens: split on whitespace, with punctuation stripped off the sides,
+    so "in-laws" or a URL stays a single token. Entries can span several tokens ("for sure") and are found with a
+    single left to right pass over the tokens, preferring the longest entry at each position.
+    An entry ending in a hyphen ("ante-") also matches the start of a hyphenated word ("ante-room"): a token is only
+    split at its first hyphen when such an entry starts there.
+    Entries are matched against lowercased text, so an entry with capitals (i.e. "I") is only ever suggested.
+    """
+
+    # key of a trie node holding the entry that ends there; tokens are never empty
+    _END = ''
+    # trie token following the head of an entry ending in a hyphen, i.e. "ante-" is ante, -
+    _HYPHEN = '-'
+
+    def __init__(self, max_sets=100000):
+        """
+        :param max_sets: (int) maximum number of homophone sets held; more are refused, to bound memory
+        """
+        self.max_sets = max_sets
+        self.root = {}
+        self.sets = {}
+        self._set_of = {}
+        self._next_id = 0
+
+    def __contains__(self, entry):
+        return entry in self._set_of
+
+    def __iter__(self):
+        return iter(self._set_of)
+
+    def __len__(self):
+        return len(self._set_of)
+
+    @staticmethod
+    def tokenize(text):
+        """
+        :param text: (str) text or entry
+        :return: (list) words with punctuation stripped off the sides except a hyphen ending a word, as in
+            TextAnalysis.tokens, without the empty ones
+        """
+        return [token for token in map(to_token, text.split()) if token]
+
+    def _path(self, entry):
+        # tokens of the trie path of a searchable entry, or None if the entry is only suggested
+        path = []
+        for word in entry.split():
+            token = strip_punctuation(word)
+            if token == word:
+                path.append(token)
+            elif token and word == token + self._HYPHEN:
+                path += [token, self._HYPHEN]
+            else:
+                return None
+        return path
+
+    def _split_hyphens(self, tokens):
+        # "ante-room" is read as ante, -, room when an entry such as "ante-" starts there; any other hyphenated
+        # token ("in-laws", a URL) stays whole, and a hyphen ending a word is dropped again
+        split = []
+        for token in tokens:
+            head, hyphen, rest = token.partition(self._HYPHEN)
+            if hyphen and token not in self.root:
+                node = self.root.get(head)
+                if node is not None and self._HYPHEN in node:
+                    split += [head, self._HYPHEN]
+                    token = rest.rstrip(self._HYPHEN)
+                elif not rest.strip(self._HYPHEN):
+                    token = head
+                if not token:
+                    continue
+            split.append(token)
+        return split
+
+    def alternatives(self, entry):
+        """
+        :param entry: (str) homophone
+        :return: (tuple) the other members of the entry's set, empty if the entry is not indexed
+        """
+        set_id = self._set_of.get(entry)
+        if set_id is None:
+            return ()
+        return tuple(member for member in self.sets[set_id] if member != entry)
+
+    def add_set(self, members):
+        """
+        Adds a set of homophones. Sets sharing a member with it are merged into one.
+
+        :param members: iterable of entries
+        :return: (int) ID of the set the members ended up in, or None if nothing was added
+        """
+        members = [member.strip() for member in members if member and member.strip()]
+        members = [member for member in members if self.tokenize(member)]
+        if not members:
+            return None
+
+        set_ids = sorted(set(self._set_of[member] for member in members if member in self._set_of))
+        if set_ids:
+            set_id = set_ids[0]
+            for other in set_ids[1:]:
+                for member in self.sets.pop(other):
+                    self.sets[set_id].append(member)
+                    self._set_of[member] = set_id
+        elif len(members) < 2:
+            return None
+        elif len(self.sets) >= self.max_sets:
+            logger.error("Homophone index is full ({n} sets). Skipping {m}.".format(n=len(self.sets), m=members))
+            return None
+        else:
+            set_id = self._next_id
+            self._next_id += 1
+            self.sets[set_id] = []
+
+        for member in members:
+            if member not in self._set_of:
+                self.sets[set_id].append(member)
+                self._set_of[member] = set_id
+                self._insert(member)
+        return set_id
+
+    def _insert(self, entry):
+        tokens = self._path(entry)
+        if tokens is None:
+            return
+        node = self.root
+        for token in tokens:
+            node = node.setdefault(sys.intern(token), {})
+        node[self._END] = entry
+
+    def remove(self, entry):
+        """
+        Removes an entry from its set. A set left with a single member is removed entirely.
+
+        :param entry: (str) homophone
+        :return: (bool) True if the entry was indexed
+        """
+        set_id = self._set_of.pop(entry, None)
+        if set_id is None:
+            return False
+        self._delete(entry)
+        members = self.sets[set_id]
+        members.remove(entry)
+        if len(members) < 2:
+            for member in members:
+                del self._set_of[member]
+                self._delete(member)
+            del self.sets[set_id]
+        return True
+
+    def _delete(self, entry):
+        tokens = self._path(entry)
+        if tokens is None:
+            return
+        path = [self.root]
+        for token in tokens:
+            path.append(path[-1][token])
+        del path[-1][self._END]
+        # prune the nodes that no longer lead to an entry
+        for i in range(len(tokens), 0, -1):
+            if path[i]:
+                break
+            del path[i - 1][tokens[i - 1]]
+
+    def update(self, homophones):
+        """
+        Adds many sets at once
+
+        :param homophones: dict of entry to an alternative or list of alternatives, an iterable of sets, or another
+            HomophoneIndex, whose sets are copied
+        :return: (int) number of sets added or merged
+        """
+        if isinstance(homophones, HomophoneIndex):
+            homophones = [list(members) for members in homophones.sets.values()]
+        elif isinstance(homophones, dict):
+            homophones = ([key] + (list(value) if isinstance(value, (list, tuple, set)) else [value])
+                          for key, value in homophones.items())
+        elif not isinstance(homophones, (list, tuple, set)) and not hasattr(homophones, '__next__'):
+            msg = "Passed data type {dt} to HomophoneIndex.update. Only dict or list allowed.".format(
+                dt=type(homophones))
+            raise exceptions.TypeNotHandledException(msg)
+
+        count = 0
+        for members in homophones:
+            if self.add_set(members) is not None:
+                count += 1
+        return count
+
+    def load_file(self, path):
+        """
+        Loads homophone sets from a text file with one comma separated set per line, i.e. "their, there, they're".
+        Blank lines and lines starting with # are skipped.
+
+        :param path: (str) file to load
+        :return: (int) number of sets added or merged
+        """
+        with open(path) as f:
+            count = self.update(line.split(',') for line in f
+                                if line.strip() and not line.lstrip().startswith('#'))
+        logger.debug("Loaded {n} homophone sets from {p}.".format(n=count, p=path))
+        return count
+
+    def find(self, tokens):
+        """
+        Finds the entries in a token sequence, taking the longest entry at each position
+
+        :param tokens: (list) tokens, as returned by tokenize()
+        :return: generator of start, end and entry for every match
+        """
+        root, end_key, n = self.root, self._END, len(tokens)
+        i = 0
+        while i < n:
+            node = root.get(tokens[i])
+            match_end, match = None, None
+            j = i + 1
+            while node is not None:
+                entry = node.get(end_key)
+                if entry is not None:
+                    match_end, match = j, entry
+                if j >= n:
+                    break
+                node = node.get(tokens[j])
+                j += 1
+            if match is None:
+                i += 1
+            else:
+                yield i, match_end, match
+                i = match_end
+
+    def find_in_text(self, text):
+        """
+        :param text: (str) lowercase message text
+        :return: (list) every entry found in the text, with its alternatives
+        """
+        return self.find_in_tokens(self.tokenize(text))
+
+    def find_in_tokens(self, tokens):
+        """
+        :param tokens: (list) lowercase message tokens, i.e. TextAnalysis.tokens
+        :return: (list) every entry found in the tokens, with its alternatives
+        """
+        if any(self._HYPHEN in token for token in tokens):
+            tokens = self._split_hyphens(tokens)
+        if self.root.keys().isdisjoint(tokens):
+            return []
+        return [(entry, self.alternatives(entry)) for _, _, entry in self.find(tokens)]
+
 
 def load_homophones(init_homophones=None):
     """
-    Takes a list of homophones and duplicates it to ensure every key is a value and vice versa
-    i.e. makes sure that if "your": "you're" is in the list, then "you're": "your" is as well
+    Builds a homophone index. Every member of a set is an alternative for the others,
+    i.e. if "your": "you're" is in the list, then "you're" suggests "your" as well
 
-    :param init_homophones: (dict) initial list of homophones to duplicate. If None, default list is provided
-    :return homophones: (dict) homophones (key) with their alternate (value)
+    :param init_homophones: dict of homophone to alternative(s), list of homophone sets, a HomophoneIndex to copy,
+        or the path of a file for HomophoneIndex.load_file. If None, default list is provided
+    :return homophones: (HomophoneIndex) indexed homophones
     """
-    if not init_homophones:
-        init_homophones = {
-            "your": "you're",
-            "air": "heir",
-            "aisle": "isle",
-            "ante-": "anti-",
-            "eye": "I",
-            "bare": "bear",
-            "be": "bee",
-            "brake": "break",
-            "buy": "by",
-            "cell": "sell",
-            "cent": "scent",
-            "cereal": "serial",
-            "coarse": "course",
-            "complement": "compliment",
-            "dam": "damn",
-            "dear": "deer",
-            "die": "dye",
-            "fair": "fare",
-            "fir": "fur",
-            "flour": "flower",
-            "for": "four",
-            "hair": "hare",
-            "heal": "heel",
-            "hear": "here",
-            "him": "hymn",
-            "hole": "whole",
-            "hour": "our",
-            "idle": "idol",
-            "in": "inn",
-            "knight": "night",
-            "knot": "not",
-            "know": "no",
-            "made": "maid",
-            "mail": "male",
-            "meat": "meet",
-            "morning": "mourning",
-            "none": "nun",
-            "oar": "or",
-            "one": "won",
-            "pair": "pear",
-            "peace": "piece",
-            "plain": "plane",
-            "poor": "pour",
-            "pray": "prey",
-            "principal": "principle",
-            "profit": "prophet",
-            "real": "reel",
-            "right": "write",
-            "root": "route",
-            "sail": "sale",
-            "sea": "see",
-            "seam": "seem",
-            "sight": "site",
-            "sew": "so",
-            "shore": "sure",
-            "sole": "soul",
-            "some": "sum",
-            "son": "sun",
-            "stair": "stare",
-            "stationary": "stationery",
-            "steal": "steel",
-            "suite": "sweet",
-            "tail": "tale",
-            "their": "there",
-            "theyre": "there",
-            "there": "they're",
-            "to": "too",
-            "toe": "tow",
-            "waist": "waste",
-            "wait": "weight",
-            "way": "weigh",
-            "weak": "week",
-            "wear": "where",
-            "hay": "hey"
-        }
-    homophones = {}
-    for ih in init_homophones:
-        try:
-            homophones[ih] = init_homophones[ih]
-        except KeyError:
-            logger.debug("Homophone already exists for {i}".format(i=ih))
-        try:
-            homophones[init_homophones[ih]] = ih
-        except KeyError:
-            logger.debug("Homophone already exists for {i}".format(i=ih))
+    homophones = HomophoneIndex()
+    if isinstance(init_homophones, str):
+        homophones.load_file(init_homophones)
+    else:
+        homophones.update(init_homophones or DEFAULT_HOMOPHONES)
     return homophones
-
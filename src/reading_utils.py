@@ -0,0 +1,68 @@
+import logging
+import re
+from array import array
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+# trailing e's of each whitespace separated word, which do not count as syllables
+TRAILING_E = re.compile(r'e+(?=\s|$)')
+VOWEL_GROUP = re.compile(r'[aeiouy]+')
+
+
+def counts(text):
+    """
+    Counts the sentences, words and syllables of a text for the Flesch-Kincaid grade level.
+    Each count is one pass over the whole text, instead of one regex call per word.
+
+    :param text: (str) text to score
+    :return: sentences (at least 1), words and syllables
+    """
+    text = text.lower()
+    sentences = text.count('.') + text.count('!') + text.count('?')
+    words = len(text.split())
+    syllables = len(VOWEL_GROUP.findall(TRAILING_E.sub('', text)))
+    return max(sentences, 1), words, syllables
+
+
+def grade(sentences, words, syllables):
+    """
+    :param sentences: (int) number of sentences
+    :param words: (int) number of words
+    :param syllables: (int) number of syllables
+    :return: (float) Flesch-Kincaid grade level
+    """
+    return 0.39*(words/sentences) + 11.8*(syllables/words) - 15.59
+
+
+def grade_level(text, min_words=1):
+    """
+    Calculates the Flesch-Kincaid grade level of a single text
+
+    :param text: (str) text to score
+    :param min_words: (int) minimum number of words needed for a score
+    :return: (float) grade level, or None if the text is shorter than min_words
+    """
+    sentences, words, syllables = counts(text)
+    if words < max(min_words, 1):
+        return None
+    return grade(sentences, words, syllables)
+
+
+def grade_levels(texts, min_words=1):
+    """
+    Calculates the Flesch-Kincaid grade level of many texts at once, i.e. for backfills or channel reports.
+    Scores each text with grade_level(), so the scores are the ones the reading_level utility gives.
+
+    :param texts: iterable of str
+    :param min_words: (int) minimum number of words needed for a score
+    :return: (array) grade level for each text, NaN where a text is shorter than min_words
+    """
+    nan = float('nan')
+    levels = array('d')
+    append = levels.append
+    for text in texts:
+        level = grade_level(text, min_words)
+        append(nan if level is None else level)
+    return levels
@@ -0,0 +1,364 @@
+import argparse
+import functools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from src.event_utils import EventRouter
+from src.slackEventHandler import SlackEventHandler
+from src.stats_utils import LatencyRecorder
+from src import web_utils
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+def load_events(path):
+    """
+    Reads recorded RTM events from a JSONL file.
+    Each line is either a single event or a list of events that were returned by one rtm_read() call.
+
+    :param path: (str) JSONL file
+    :return: list of batches, each a list of events
+    """
+    batches = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            frame = json.loads(line)
+            batches.append(frame if isinstance(frame, list) else [frame])
+    return batches
+
+
+class FakeServer:
+
+    def __init__(self, username):
+        self.username = username
+        self.connected = False
+
+
+class FakeSlackClient:
+    """
+    In-process stand-in for SlackClient. Serves recorded events from rtm_read(), answers the Web API methods the
+    handler uses from canned data, records outbound messages and counts API calls.
+    Can drop the RTM connection every few reads and, like Slack, deliver recent events again after a reconnect.
+    A drop either clears server.connected or, like a closed socket, makes the next read or send raise.
+    """
+
+    def __init__(self, batches, users=None, channels=None, members=None, latency=0.0, username='replay',
+                 disconnect_every=0, redeliver=0, disconnect_error=False):
+        """
+        :param batches: (list) batches of events, as returned by load_events
+        :param users: (list) Slack user objects returned by users.list
+        :param channels: (list) conversation objects returned by conversations.list
+        :param members: (dict) channel ID to list of member IDs for conversations.members
+        :param latency: (float) seconds every API call and send takes
+        :param username: (str) username of the connected user
+        :param disconnect_every: (int) number of reads after which the connection drops; 0 to never drop it
+        :param redeliver: (int) number of already read events served again after each reconnect
+        :param disconnect_error: (bool) True if a drop raises ConnectionError from the next read or send instead of
+            clearing server.connected
+        """
+        self.batches = list(batches)
+        self.users = users or []
+        self.channels = channels or []
+        self.members = members or {}
+        self.latency = latency
+        self.server = FakeServer(username)
+        self.api_calls = {}
+        self.sent = []
+        self.reads = 0
+        self.connects = 0
+        self.disconnect_every = disconnect_every
+        self.redeliver = redeliver
+        self.disconnect_error = disconnect_error
+        self._redelivered = None
+        self._broken = False
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def rtm_connect(self, **kwargs):
+        self._wait()
+        if self.reads >= len(self.batches):
+            # recording exhausted
+            return False
+        if self.connects and self.redeliver:
+            read = [event for batch in self.batches[:self.reads] for event in batch]
+            self._redelivered = read[-self.redeliver:]
+        self.connects += 1
+        self.server.connected = True
+        self._broken = False
+        return True
+
+    def _check_socket(self):
+        if self._broken:
+            raise ConnectionError("Replayed socket closed")
+
+    def rtm_read(self):
+        self._check_socket()
+        if self._redelivered:
+            batch, self._redelivered = self._redelivered, None
+            return batch
+        self.reads += 1
+        if self.reads > len(self.batches):
+            # recording exhausted
+            self.server.connected = False
+            return []
+        if self.disconnect_every and self.reads % self.disconnect_every == 0:
+            if self.disconnect_error:
+                self._broken = True
+            else:
+                self.server.connected = False
+        return self.batches[self.reads - 1]
+
+    def rtm_send_message(self, channel, message):
+        self._check_socket()
+        self._wait()
+        self.sent.append((channel, message))
+
+    def api_call(self, method, **kwargs):
+        self._wait()
+        self.api_calls[method] = self.api_calls.get(method, 0) + 1
+
+        if method == 'users.list':
+            return {'ok': True, 'members': self.users}
+        elif method == 'conversations.list':
+            return {'ok': True, 'channels': self.channels}
+        elif method == 'conversations.members':
+            return {'ok': True, 'members': self.members.get(kwargs.get('channel'), [])}
+        elif method in ('im.info', 'groups.info'):
+            prefix = 'D' if method == 'im.info' else 'G'
+            channel = kwargs.get('channel') or ''
+            return {'ok': channel.startswith(prefix)}
+        return {'ok': True}
+
+
+class FakeGiphy:
+    """
+    Stand-in for giphypop.Giphy that yields made-up gif URLs after a delay
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.searches = 0
+
+    def search(self, term=None, limit=25, **kwargs):
+        self.searches += 1
+        if self.latency:
+            time.sleep(self.latency)
+        for i in range(limit):
+            yield 'https://giphy.com/gifs/replay-{t}-{i}'.format(t=term.replace(' ', '-'), i=i)
+
+
+class FakeWeb:
+    """
+    Replaces the web_utils endpoints (Genius and the bad word list) with canned data and injected latency
+    while in use as a context manager
+    """
+
+    ENDPOINTS = ('get_top_songs', 'get_song', 'get_bad_words')
+
+    def __init__(self, latency=0.0, bad_words=None):
+        """
+        :param latency: (float) seconds every endpoint call takes
+        :param bad_words: (set) words returned by get_bad_words
+        """
+        self.latency = latency
+        self.bad_words = set(bad_words or ['darn', 'heck'])
+        self.calls = 0
+        self._saved = {}
+
+    def _wait(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_top_songs(self, use_cache=True):
+        self._wait()
+        return ['https://genius.com/replay-song-{i}-lyrics'.format(i=i) for i in range(10)]
+
+    def get_song(self, url, use_cache=True):
+        self._wait()
+        return {'url': url, 'artist': 'Replay Artist', 'song': url.rsplit('/', 1)[-1],
+                'lyrics': ['la la la', 'na na na']}
+
+    def get_bad_words(self):
+        self._wait()
+        return set(self.bad_words)
+
+    def __enter__(self):
+        for name in self.ENDPOINTS:
+            self._saved[name] = getattr(web_utils, name)
+            setattr(web_utils, name, getattr(self, name))
+        return self
+
+    def __exit__(self, *args):
+        for name in self._saved:
+            setattr(web_utils, name, self._saved[name])
+        self._saved = {}
+
+
+def time_handlers(seh, recorder):
+    """
+    Wraps every enabled utility of the handler so each call is timed
+
+    :param seh: SlackEventHandler
+    :param recorder: (LatencyRecorder) where the timings go
+    :return: None
+    """
+    def timed(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                recorder.record(handler.__name__, time.time() - start)
+        return wrapper
+
+    seh.handlers = tuple(timed(handler) for handler in seh.handlers)
+    seh.router = EventRouter(seh.handlers)
+
+
+def replay(path, latency=0.0, web_latency=0.0, users=None, channels=None, members=None, disconnect_every=0,
+           redeliver=0, disconnect_error=False, **handler_kwargs):
+    """
+    Feeds a JSONL file of recorded RTM events through a SlackEventHandler running against FakeSlackClient,
+    FakeGiphy and FakeWeb
+
+    :param path: (str) JSONL file of recorded events
+    :param latency: (float) seconds every Slack API call and send takes
+    :param web_latency: (float) seconds every Giphy and web_utils call takes
+    :param users: (list) Slack user objects returned by users.list
+    :param channels: (list) conversation objects returned by conversations.list
+    :param members: (dict) channel ID to list of member IDs
+    :param disconnect_every: (int) number of reads after which the connection drops; 0 to never drop it
+    :param redeliver: (int) number of already read events served again after each reconnect
+    :param disconnect_error: (bool) True if drops raise ConnectionError instead of clearing server.connected
+    :param handler_kwargs: arguments for SlackEventHandler, i.e. handler_flags, run_level and io_workers
+    :return: (dict) events, unrouted events, duplicates skipped, reconnects, seconds (without the final drain),
+        drain_seconds, events_per_sec, api_calls, api_calls_per_event, sent, outbound queue stats, utility pool
+        stats (None when running inline) and handler latencies
+    """
+    batches = load_events(path)
+    client = FakeSlackClient(batches, users=users, channels=channels, members=members, latency=latency,
+                             disconnect_every=disconnect_every, redeliver=redeliver,
+                             disconnect_error=disconnect_error)
+    handler_kwargs.setdefault('users', [])
+    handler_kwargs.setdefault('stay_channel', 'replay')
+    handler_kwargs.setdefault('run_level', 'All')
+    # once the recording is exhausted the client refuses to reconnect, which ends the replay
+    handler_kwargs.setdefault('reconnect_attempts', 1)
+    handler_kwargs.setdefault('reconnect_backoff', 0.0)
+    # nothing a replay does may end up in the bot's own cache directory: the bad words are passed in, so no
+    # snapshot is loaded or refreshed, and the warm start snapshot and the Genius cache go to a scratch directory
+    fake_web = FakeWeb(latency=web_latency)
+    handler_kwargs.setdefault('bad_words', sorted(fake_web.bad_words))
+    scratch = tempfile.mkdtemp(prefix='replay-')
+    handler_kwargs.setdefault('state_path', os.path.join(scratch, 'state.json'))
+    genius_path = web_utils.genius_cache.path
+    web_utils.set_cache_dir(scratch)
+
+    try:
+        with fake_web:
+            seh = SlackEventHandler('xoxb-replay', client_factory=lambda token: client, **handler_kwargs)
+            seh.gifs._giphy = FakeGiphy(latency=web_latency)
+            recorder = LatencyRecorder()
+            time_handlers(seh, recorder)
+            # the final drain of the outbound queue is timed on its own, so it does not count against throughput
+            drain = seh.drain
+            drained = []
+
+            def timed_drain(*args):
+                drain_start = time.time()
+                try:
+                    return drain(*args)
+                finally:
+                    drained.append(time.time() - drain_start)
+            seh.drain = timed_drain
+
+            start = time.time()
+            seh.begin()
+            # begin() stops the song prefetcher with a timeout; it must not outlive the fake endpoints
+            seh.songs.stop()
+            drain_seconds = sum(drained)
+            seconds = time.time() - start - drain_seconds
+    finally:
+        web_utils.genius_cache.path = genius_path
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    throughput = seh.get_throughput()
+    events = throughput['events']
+    api_calls = sum(client.api_calls.values())
+    return {
+        'events': events,
+        'unrouted': throughput['unrouted'],
+        'duplicates': throughput['duplicates'],
+        'reconnects': throughput['reconnects'],
+        'seconds': seconds,
+        'drain_seconds': drain_seconds,
+        'events_per_sec': events / seconds if seconds > 0 else 0.0,
+        'api_calls': dict(client.api_calls),
+        'api_calls_per_event': api_calls / events if events else 0.0,
+        'sent': len(client.sent),
+        'outbound': seh.outbound.get_stats(),
+        'io': seh.io.get_stats() if seh.io is not None else None,
+        'handlers': recorder.summary()
+    }
+
+
+def format_report(result):
+    """
+    :param result: (dict) result of replay()
+    :return: (str) human readable report
+    """
+    lines = [
+        "Replayed {e} events in {s:.2f}s ({r:.1f} events/sec), {u} not routed to any utility".format(
+            e=result['events'], s=result['seconds'], r=result['events_per_sec'], u=result['unrouted']),
+        "Reconnects: {r}, duplicate events skipped: {d}".format(r=result['reconnects'], d=result['duplicates']),
+        "Drained the outbound queue for {s:.2f}s at the end".format(s=result['drain_seconds']),
+        "API calls per event: {c:.2f} {d}".format(c=result['api_calls_per_event'], d=result['api_calls']),
+        "Messages sent: {n}, still queued at the end: {q}".format(n=result['sent'],
+                                                                 q=result['outbound']['depth']),
+        "Utility pool: {p}".format(p=result['io'] if result['io'] is not None else 'inline'),
+        "{h:<30} {n:>8} {p50:>10} {p90:>10} {p99:>10} {mx:>10}".format(
+            h='utility', n='calls', p50='p50 ms', p90='p90 ms', p99='p99 ms', mx='max ms')
+    ]
+    for name in sorted(result['handlers']):
+        stats = result['handlers'][name]
+        lines.append("{h:<30} {n:>8} {p50:>10.3f} {p90:>10.3f} {p99:>10.3f} {mx:>10.3f}".format(
+            h=name, n=stats['count'], p50=stats['p50'] * 1000, p90=stats['p90'] * 1000,
+            p99=stats['p99'] * 1000, mx=stats['max'] * 1000))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded RTM events through a SlackEventHandler")
+    parser.add_argument('path', help="JSONL file of recorded RTM events")
+    parser.add_argument('--flags', default='homophone_suggest_flg,reading_level_flg',
+                        help="comma separated handler flags to enable")
+    parser.add_argument('--run-level', default='All')
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds per Slack API call")
+    parser.add_argument('--web-latency', type=float, default=0.0, help="seconds per Giphy/web call")
+    parser.add_argument('--io-workers', type=int, default=0, help="threads for the network bound utilities")
+    parser.add_argument('--disconnect-every', type=int, default=0, help="reads after which the connection drops")
+    parser.add_argument('--redeliver', type=int, default=0, help="events delivered again after each reconnect")
+    parser.add_argument('--disconnect-error', action='store_true',
+                        help="drops raise ConnectionError instead of clearing server.connected")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    flags = dict((flg, True) for flg in args.flags.split(',') if flg)
+    result = replay(args.path, latency=args.latency, web_latency=args.web_latency,
+                    handler_flags=flags, run_level=args.run_level, io_workers=args.io_workers,
+                    disconnect_every=args.disconnect_every, redeliver=args.redeliver,
+                    disconnect_error=args.disconnect_error)
+    logger.info('\n' + format_report(result))
@@ -0,0 +1,30 @@
+import json
+import logging
+import os
+import sys
+
+from src.supervisor import Supervisor
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+if __name__ == '__main__':
+    # JSON config, i.e.
+    # {"processes": 2,
+    #  "workspaces": [{"name": "acme", "token_env": "ACME_SLACK_BOT_TOKEN", "run_level": "All", "users": "All",
+    #                  "stay_channel": "slack_py_test", "handler_flags": {"homophone_suggest_flg": true}}]}
+    config_path = sys.argv[1] if len(sys.argv) > 1 else os.environ["USELESS_SLACK_WORKSPACES"]
+    with open(config_path) as f:
+        config = json.load(f)
+
+    workspaces = config['workspaces']
+    for workspace in workspaces:
+        if 'token' not in workspace:
+            workspace['token'] = os.environ[workspace['token_env']]
+
+    supervisor = Supervisor(workspaces,
+                            processes=config.get('processes'),
+                            cache_dir=config.get('cache_dir'),
+                            report_interval=config.get('report_interval', 300))
+    supervisor.run()
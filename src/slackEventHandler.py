@@ -1,14 +1,29 @@
+import hashlib
+import importlib
+import json
 import logging
+import os
+import tempfile
+import threading
 import time
 import random
 from slackclient import SlackClient
-import giphypop
-import re
+from slackclient.server import SlackConnectionError
+from websocket import WebSocketConnectionClosedException
 
-from src.str_utils import find_element_in_string, strip_punctuation
+from src.str_utils import find_element_in_string
+from src.event_utils import EventContext, EventRouter, subscribe
 from src.misc_utils import load_homophones
-from src import web_utils
+from src.cache_utils import DEFAULT_CACHE_DIR, TTLCache
+from src.slack_utils import ChannelTypeCache, MembershipIndex, UserDirectory, InstrumentedClient
+from src.stats_utils import Metrics
+from src.gif_utils import GifResolver
+from src.message_utils import MessageScheduler, OutboundQueue
+from src.song_utils import SongPool
+from src.word_utils import BadWordList, ProfanityMatcher
+from src.worker_utils import ChannelExecutor, backoff_delay
 from src import exceptions
+from src import reading_utils
 
 logger = logging.getLogger()
 logging.basicConfig()
@@ -17,6 +32,25 @@ logger.setLevel(logging.DEBUG)
 
 class SlackEventHandler:
 
+    MAGIC_EIGHT_QUERY = 'magic eight ball'
+    MAGIC_EIGHT_TOP = 11
+    # utilities that wait on the network; run on the utility pool when io_workers is set
+    IO_UTILITIES = frozenset(['random_reply', 'magic_eight', 'sing_to_me', 'someones_talking_about_you'])
+    # optional modules needed by each utility; only imported once the utility is enabled, see load_dependencies()
+    DEPENDENCIES = {
+        'random_gif_flg': ('giphypop',),
+        'magic_eight_flg': ('giphypop',),
+        'sing_to_me_flg': ('requests', 'lxml.html'),
+        'clean_your_mouth_with_soap_flg': ('requests',)
+    }
+    # utilities that read the message type or the user directory, which begin() only loads up front for them
+    MSG_TYPE_UTILITIES = frozenset(['mark_read', 'someones_talking_about_you'])
+    DIRECTORY_UTILITIES = frozenset(['someones_talking_about_you'])
+    # bumped whenever the layout of the warm start snapshot changes
+    STATE_VERSION = 1
+    # raised by rtm_read() and rtm_send_message() when the RTM socket drops, instead of clearing server.connected
+    CONNECTION_ERRORS = (SlackConnectionError, WebSocketConnectionClosedException, ConnectionError)
+
     def __init__(self,
                  slack_token,
                  random_reply_flg=False,
@@ -36,7 +70,20 @@ class SlackEventHandler:
                  stay_channel=None,
                  init_homophones=None,
                  min_words=10,
-                 bad_words=None):
+                 bad_words=None,
+                 poll_interval=0.1,
+                 client_factory=None,
+                 metrics_interval=300,
+                 gif_cache=None,
+                 io_workers=0,
+                 io_queue=200,
+                 warm_start=False,
+                 state_path=None,
+                 reconnect_attempts=None,
+                 reconnect_backoff=1.0,
+                 max_reconnect_backoff=60.0,
+                 dedup_window=1000,
+                 drain_timeout=5.0):
         """
         :param slack_token: (str) API token to connect to Slack
         :param random_reply_flg: (Bool) True if you want the handler to perform the random_reply handling
@@ -56,13 +103,39 @@ class SlackEventHandler:
         :param users: ([str]) List of users for whom events should be handled, or 'All'; defaults to None
         :param responses: ([str]) If using the random_reply, this is the list of custom responses
         :param stay_channel: (str) channel to use if you're doing someones_talking_about_you
-        :param init_homophones: (dict) override dictionary of homophones to use
+        :param init_homophones: override homophones to use: a dict, a list of sets, a file path, or a HomophoneIndex
+            (copied, so add_homophones does not change the original)
         :param min_words: (int) minimum number of words allows for a reading_level check
-        :param bad_words: (list) override of bad words for clean_your_mouth_with_soap
+        :param bad_words: (list) override of bad words for clean_your_mouth_with_soap. If None, the list is loaded
+            from a local snapshot and refreshed from the web in the background. A BadWordList is used as is
+        :param poll_interval: (float) seconds to wait before reading again when rtm_read() returns no events
+        :param client_factory: callable taking the slack token and returning a client; defaults to SlackClient.
+            Lets the replay harness run the handler against a stand-in client
+        :param metrics_interval: (float) seconds between logged dumps of the latency metrics; None to disable
+        :param gif_cache: (DiskCache) optional on-disk gif cache, i.e. shared by several handlers
+        :param io_workers: (int) number of threads running the network bound utilities (IO_UTILITIES), in order per
+            channel; 0 runs every utility inline
+        :param io_queue: (int) maximum number of events waiting for the utility threads; more are dropped
+        :param warm_start: (bool) if True, the user directory, channel types and gif cache are restored from a local
+            snapshot instead of fetched before handling starts, reconciled with Slack in the background, and saved
+            again when begin() returns
+        :param state_path: (str) snapshot file for warm_start; defaults to one file per token in the cache directory
+        :param reconnect_attempts: (int) failed reconnects in a row after which begin() gives up when the RTM
+            connection drops; None to keep trying, 0 to return as soon as the connection drops
+        :param reconnect_backoff: (float) seconds to wait before the first reconnect, doubling with every failure
+        :param max_reconnect_backoff: (float) cap on the wait between reconnects
+        :param dedup_window: (int) number of recent (channel, ts) pairs remembered, so events Slack delivers again
+            around a reconnect are handled once
+        :param drain_timeout: (float) seconds begin() keeps sending queued and scheduled messages before it returns.
+            Messages still waiting after that are saved with the warm start snapshot, or dropped without warm_start
         """
 
         self.slack_token = None
         self.update_slack_token(slack_token)
+        self.client_factory = client_factory or SlackClient
+        self.metrics = Metrics()
+        self.metrics_interval = metrics_interval
+        self._next_metrics_dump = None
 
         # handle flags for handling methods
         self.handler_flags = {
@@ -78,6 +151,8 @@ class SlackEventHandler:
             'clean_your_mouth_with_soap_flg': False
         }
 
+        self.handlers = ()
+        self.router = EventRouter()
         if handler_flags:
             for flg in handler_flags:
                 try:
@@ -89,28 +164,32 @@ class SlackEventHandler:
                     logging.debug("Flag {f} is not a valid handling method.".format(f=flg) +
                                   " It will not be included in the event handler.")
         else:
+            flag_args = {
+                'random_reply_flg': random_reply_flg,
+                'random_gif_flg': random_gif_flg,
+                'set_typing_flg': set_typing_flg,
+                'mark_read_flg': mark_read_flg,
+                'someones_talking_about_you_flg': someones_talking_about_you_flg,
+                'magic_eight_flg': magic_eight_flg,
+                'homophone_suggest_flg': homophone_suggest_flg,
+                'reading_level_flg': reading_level_flg,
+                'sing_to_me_flg': sing_to_me_flg,
+                'clean_your_mouth_with_soap_flg': clean_your_mouth_with_soap_flg
+            }
             for flg in self.handler_flags:
-                eval("self.update_flag('{f}',{f})".format(f=flg))
-
-            # Old non-parameterized code
-            '''
-            self.update_flag('random_reply_flg', random_reply_flg)
-            self.update_flag('random_gif_flg', random_gif_flg)
-            self.update_flag('set_typing_flg', set_typing_flg)
-            self.update_flag('mark_read_flg', mark_read_flg)
-            self.update_flag('someones_talking_about_you_flg', someones_talking_about_you_flg)
-            self.update_flag('magic_eight_flg', magic_eight_flg)
-            self.update_flag('homophone_suggest_flg', homophone_suggest_flg)
-            self.update_flag('reading_level_flg', reading_level_flg)
-            self.update_flag('sing_to_me_flg', sing_to_me_flg)
-            self.update_flag('clean_your_mouth_with_soap_flg', clean_your_mouth_with_soap_flg)
-            '''
+                self.update_flag(flg, flag_args[flg])
+
         # handle bad_words
+        self.bad_word_matcher = None
         if self.handler_flags['clean_your_mouth_with_soap_flg']:
-            if bad_words:
+            if isinstance(bad_words, BadWordList):
+                # shared with other handlers, i.e. by the supervisor
+                self.bad_words = bad_words
+            elif bad_words:
                 try:
                     if type(bad_words) in (list, set):
                         self.bad_words = set(bad_words)
+                        self.bad_word_matcher = ProfanityMatcher(self.bad_words)
                     else:
                         raise TypeError
                 except TypeError:
@@ -118,18 +197,33 @@ class SlackEventHandler:
                                  format(t=type(bad_words)))
                     raise
             else:
-                self.bad_words = web_utils.get_bad_words()
+                # loaded from the local snapshot; begin() refreshes it from the web in the background
+                self.bad_words = BadWordList()
+                self.bad_words.load_snapshot()
 
         # handle run_level
         self.run_level = None
         self.update_run_level(run_level)
 
+        # handle warm start
+        self.warm_start = warm_start
+        self.state_path = state_path or os.path.join(
+            DEFAULT_CACHE_DIR, 'state-{t}.json'.format(t=hashlib.sha1(slack_token.encode('utf-8')).hexdigest()[:12]))
+        state = self.read_state() if warm_start else None
+        self.state_loaded = state is not None
+        self._reconciled = None
+        self._user_events = None
+
         # handle users
+        self.user_directory = UserDirectory()
+        self.users_all = users == 'All'
+        if state is not None:
+            self.user_directory.restore(state['users'])
         try:
             if users == 'All':
-                sc = SlackClient(self.slack_token)
-                sc.rtm_connect()
-                self.users = [user['id'] for user in sc.api_call("users.list")['members']]
+                if not self.user_directory.loaded:
+                    self.user_directory.load(self.new_client())
+                self.users = list(self.user_directory.ids)
             elif type(users) == list:
                 self.users = users
             else:
@@ -177,6 +271,31 @@ class SlackEventHandler:
             logger.error("Invalid type {t} for min_words; expected int".format(t=type(min_words)))
             raise
 
+        self.poll_interval = poll_interval
+        self.channel_types = ChannelTypeCache()
+        self.memberships = MembershipIndex()
+        self.gifs = GifResolver(disk_cache=gif_cache)
+        self.scheduler = MessageScheduler()
+        self.outbound = OutboundQueue()
+        self.songs = SongPool()
+        self.io = ChannelExecutor(max_workers=io_workers, max_queued=io_queue) if io_workers else None
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_backoff = reconnect_backoff
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self.seen_events = TTLCache(max_size=dedup_window)
+        self.drain_timeout = drain_timeout
+        if state is not None:
+            self.channel_types.restore(state['channel_types'])
+            self.gifs.restore(state['gifs'])
+            # JSON turns the (channel, ts) keys into lists
+            self.seen_events.restore([[tuple(key), value, expires]
+                                      for key, value, expires in state.get('seen_events', [])])
+            # messages that were still waiting when the last run stopped
+            self.outbound.restore(state.get('outbound', []))
+            self.scheduler.restore(state.get('scheduled', []))
+        self.throughput = None
+        self.reset_throughput()
+
     # Helper methods. Most of them just wrap some error handling and validation around updates
 
     def update_run_level(self, new_run_level):
@@ -260,11 +379,32 @@ class SlackEventHandler:
                            n=', '.join(self.handler_flags.keys()))
                 raise exceptions.InvalidFlagNameException(message=message)
             self.handler_flags[flag_name] = flag_value
+            self.build_handlers()
 
         except exceptions.InvalidFlagNameException as e:
             logger.error(e.message)
             raise
 
+    def build_handlers(self):
+        """
+        Resolves the enabled flags into an immutable tuple of bound utility methods, so begin() does not have to
+        look them up for every event, and routes events to them by the types the utilities subscribe to.
+        Called whenever a flag changes.
+        Flags without a utility method (i.e. planned utilities) are skipped.
+
+        :return: None
+        """
+        handlers = []
+        for flg in self.handler_flags:
+            if self.handler_flags[flg] and flg != 'random_gif_flg':
+                handler = getattr(self, flg.replace('_flg', ''), None)
+                if handler is None:
+                    logger.debug("No utility implemented for flag {f}. Skipping it.".format(f=flg))
+                else:
+                    handlers.append(handler)
+        self.handlers = tuple(handlers)
+        self.router = EventRouter(self.handlers)
+
     def add_responses(self, new_responses):
         """
         Add 1+ responses for the random_reply method
@@ -290,33 +430,31 @@ class SlackEventHandler:
 
     def add_homophones(self, new_homophones, override_flg=True):
         """
-        add_homophones adds additional homophones to the existing dictionary
-        :param new_homophones: (dict) new homophones to add
-        :param override_flg: (Bool) if True, then if there is a conflict between new and old dicts, replace old.
-            If false, keep old.
+        add_homophones adds additional homophones to the existing index
+        :param new_homophones: (dict) new homophones to add, each with an alternative or a list of alternatives;
+            or a list of homophone sets
+        :param override_flg: (Bool) if True, a new homophone that is already in a set is moved to its new set.
+            If false, keep old sets and merge the new homophones into them.
         :return: None
         """
 
         try:
             if type(new_homophones) == dict:
-                new_homophones = load_homophones(new_homophones)
-                for nh in new_homophones:
-                    nh_exists = nh in self.homophones.keys()
-                    if override_flg or not nh_exists:
-                        tmp = None
-                        if nh_exists:
-                            tmp = self.homophones[nh]
-                        self.homophones[nh] = new_homophones[nh]
-
-                        # remove old match if overriding
-                        if override_flg and nh_exists:
-                            del self.homophones[tmp]
-
+                new_sets = [[key] + (list(value) if isinstance(value, (list, tuple, set)) else [value])
+                            for key, value in new_homophones.items()]
+            elif type(new_homophones) == list:
+                new_sets = [list(members) for members in new_homophones]
             else:
-                msg = "Passed data type {dt} to method 'add_homophones.' Only dict allowed.". \
+                msg = "Passed data type {dt} to method 'add_homophones.' Only dict or list allowed.". \
                     format(dt=type(new_homophones))
                 raise exceptions.TypeNotHandledException(msg)
 
+            for members in new_sets:
+                if override_flg:
+                    for member in members:
+                        self.homophones.remove(member)
+                self.homophones.add_set(members)
+
         except exceptions.TypeNotHandledException as e:
             logger.error(e.message)
             raise
@@ -333,9 +471,9 @@ class SlackEventHandler:
 
         try:
             if type(new_users) == str and new_users == 'All':
-                sc = SlackClient(self.slack_token)
-                sc.rtm_connect()
-                self.users = [user['id'] for user in sc.api_call("users.list")['members']]
+                if not self.user_directory.loaded:
+                    self.user_directory.load(self.new_client())
+                self.users = list(self.user_directory.ids)
             if type(new_users) == str and new_users not in self.users:
                 self.users.append(new_users)
             elif type(new_users) == list:
@@ -349,6 +487,13 @@ class SlackEventHandler:
             logger.error(e.message)
             raise
 
+    def new_client(self):
+        """
+        Creates a client for the handler's slack token, instrumented so API calls and sends are timed
+        :return: InstrumentedClient wrapping a SlackClient, or whatever client_factory returns
+        """
+        return InstrumentedClient(self.client_factory(self.slack_token), self.metrics)
+
     def get_util_flag_choices(self):
         """
         Returns list of possible utility flags to choose from
@@ -358,16 +503,12 @@ class SlackEventHandler:
 
     def get_users(self):
         """
-        Calls Slack Client and gets all users
+        Gets all users from the user directory, loading it from Slack the first time
         :return: List of dicts with users
         """
-        sc = SlackClient(self.slack_token)
-        return [{'name': user['name'],
-                 'id': user['id'],
-                 'first_name': user['profile']['first_name'],
-                 'last_name': user['profile']['last_name']}
-                for user in sc.api_call("users.list")['members']
-                if 'first_name' in user['profile'].keys() and 'last_name' in user['profile'].keys()]
+        if not self.user_directory.loaded:
+            self.user_directory.load(self.new_client())
+        return list(self.user_directory.users)
 
     def search_user_by_name(self, username=None, first_name=None, last_name=None):
         """
@@ -377,23 +518,14 @@ class SlackEventHandler:
         :param last_name:
         :return:
         """
-        users = self.get_users()
         try:
-            if username:
-                return [user for user in users if user['name'].lower() == username.lower()]
-            elif first_name and last_name:
-                return [user for user in users if user['first_name'].lower() == first_name.lower() and
-                        user['last_name'].lower() == last_name.lower()]
-            elif first_name:
-                return [user for user in users if user['first_name'].lower() == first_name.lower()]
-            elif last_name:
-                return [user for user in users if user['last_name'].lower() == last_name.lower()]
+            if username or first_name or last_name:
+                if not self.user_directory.loaded:
+                    self.user_directory.load(self.new_client())
+                return self.user_directory.search(username=username, first_name=first_name, last_name=last_name)
             else:
                 message = "Expected username, first_name or last_name. None found."
                 raise exceptions.NoArgumentsPassedException(message)
-        except KeyError:
-            logger.error("Expected username, first_name or last_name. None found.")
-            raise
         except exceptions.NoArgumentsPassedException as e:
             logger.error(e.message)
             raise
@@ -401,102 +533,525 @@ class SlackEventHandler:
     def begin(self, length=-1):
         """
         Begin kicks of the event handling process.
-        Uses eval() to call handling method. Currently passes sc, event, msg_type and all_users to method.
-        If you add a utility that uses any other arguments, you will need to update this line
+        Every frame in a batch returned by rtm_read() is handled; the loop only sleeps when the batch is empty.
+        If the RTM connection drops, it reconnects with backoff and carries on with its queues and the dedup window
+        intact. Channel members are fetched again and the user directory is reloaded in the background, since
+        membership and user events sent while disconnected are lost.
+        Calls each utility subscribed to an event with sc, event and an EventContext, which computes msg_type,
+        text and members on first use. Add new per-event facts to EventContext.
 
         :param length: (int) Number of seconds to continue loop; -1 if should not end
         :return: None
         """
 
-        sc = SlackClient(self.slack_token)
+        sc = self.new_client()
+        start_time = time.time()
 
         try:
             if sc.rtm_connect(with_team_state=False):
-                # get list of all users
-                all_users = [
-                    {
-                        'name': user['name'],
-                        'id': user['id'],
-                        'first_name': user['profile']['first_name'],
-                        'last_name': user['profile']['last_name']
-                    }
-                    for user in sc.api_call("users.list")['members']
-                    if 'first_name' in user['profile'].keys() and 'last_name' in user['profile'].keys()]
+                if self.state_loaded:
+                    # start from the snapshot right away; the live lists are swapped in once they arrive
+                    self.reconcile(sc)
+                else:
+                    names = set(handler.__name__ for handler in self.handlers)
+                    # get list of all users, unless the directory was already loaded by __init__
+                    if not self.user_directory.loaded and not names.isdisjoint(self.DIRECTORY_UTILITIES):
+                        self.user_directory.load(sc)
+
+                    # classify every visible conversation up front so events don't need im.info/groups.info
+                    if self.run_level != 'All' or not names.isdisjoint(self.MSG_TYPE_UTILITIES):
+                        self.channel_types.load(sc)
+                self.load_dependencies(self.handler_flags)
+                self.prefetch_gifs()
+                if self.handler_flags['sing_to_me_flg']:
+                    self.songs.start()
+                if self.handler_flags['clean_your_mouth_with_soap_flg'] and isinstance(self.bad_words, BadWordList):
+                    self.bad_words.start_refresh()
 
                 start_time = time.time()
+                deadline = start_time + length if length != -1 else None
+                self.reset_throughput()
                 # connect to server and start monitoring
-                while sc.server.connected and (time.time() <= start_time+length or length == -1):
-                    event = sc.rtm_read()
+                while time.time() <= start_time+length or length == -1:
+                    # a dropped connection is reopened on the same client, keeping every cache
+                    if not sc.server.connected and not self.reconnect(sc, deadline):
+                        break
+                    self.apply_reconciled()
                     try:
-                        if event:
-                            logger.debug(event)
-
-                            # check event type and determine if action should be taken
-                            msg_type = self.get_msg_type(sc, event)
-                            logger.debug(msg_type)
-                            if (self.run_level == 'DM Only' and msg_type == 'IM') or \
-                                (self.run_level == 'Private' and msg_type != 'Public') or\
-                                    self.run_level == 'All':
-
-                                # if message is in correct scope, perform designated tasks
-                                for flg in self.handler_flags:
-                                    if self.handler_flags[flg] and flg != 'random_gif_flg':
-                                        eval_line = 'self.{f}(sc, event, msg_type, all_users)'.\
-                                            format(f=flg.replace('_flg', ''))
-                                        eval(eval_line)
-                                # Old non-parameterized code for calling utilities
-                                '''
-                                if self.handler_flags['random_reply_flg']:
-                                    self.random_reply(sc, event)
-                                if self.handler_flags['mark_read_flg']:
-                                    self.mark_read(sc, event, msg_type)
-                                if self.handler_flags['someones_talking_about_you_flg']:
-                                    self.someones_talking_about_you(sc, event, msg_type, all_users)
-                                if self.handler_flags['magic_eight_flg']:
-                                    self.magic_eight(sc, event)
-                                if self.handler_flags['homophone_flg']:
-                                    self.homophone_suggest(sc, event)
-                                if self.handler_flags['reading_level_flg']:
-                                    self.reading_level(sc, event)
-                                if self.handler_flags['sing_to_me_flg']:
-                                    self.sing_to_me(sc, event)
-                                if self.handler_flags['clean_your_mouth_with_soap_flg']:
-                                    self.clean_your_mouth_with_soap(sc, event)
-                                '''
-                            else:
-                                logger.debug("Message not in scope.")
-
-                    except KeyError:
-                        logger.debug("Ignore this event: " + str(event))
-
-                    time.sleep(1)
-
-            if time.time() > start_time + length:
+                        events = sc.rtm_read()
+                        if events:
+                            self.handle_events(sc, events)
+                        self.scheduler.run_due(self.send_message)
+                        self.outbound.flush(sc.rtm_send_message)
+                    except self.CONNECTION_ERRORS as e:
+                        logger.error("RTM connection failed: {e}".format(e=e))
+                        if not self.reconnect(sc, deadline):
+                            break
+                        continue
+                    self.dump_metrics()
+                    if not events:
+                        self.idle()
+
+            if length != -1 and time.time() > start_time + length:
                 logger.debug("Event handling completed.\nStopping Slack monitor.")
         except KeyboardInterrupt:
             logger.debug("Stopping Slack monitor.")
             raise
+        finally:
+            if self.io is not None:
+                # replies the pool is still working on are drained and saved with the rest
+                finished = self.io.join(self.drain_timeout)
+                if not finished:
+                    logger.warning("Utility pool still busy after {t}s: {s}".format(t=self.drain_timeout,
+                                                                                      s=self.io.get_stats()))
+                self.io.shutdown(wait=finished)
+            left = self.drain(sc, self.drain_timeout)
+            if self.warm_start:
+                self.save_state()
+            elif left:
+                logger.warning("Dropping {n} messages that could not be sent.".format(n=left))
+            self.close()
+
+    def close(self):
+        """
+        Stops the background threads the handler started, so they do not outlive it: the song prefetcher and the
+        utility pool. Called at the end of begin(). A reconcile() still fetching ends on its own.
+        :return: None
+        """
+        if not self.songs.stop(self.drain_timeout):
+            logger.warning("Song prefetcher still busy after {t}s.".format(t=self.drain_timeout))
+        if self.io is not None:
+            self.io.shutdown(wait=False)
+
+    def drain(self, sc, timeout):
+        """
+        Sends the messages still waiting in the scheduler and the outbound queue, within their rate limits, until
+        both are empty, the timeout runs out or the connection fails
+
+        :param sc: SlackClient used to connect to server
+        :param timeout: (float) seconds to keep sending at most
+        :return: (int) number of messages left unsent
+        """
+        deadline = time.time() + timeout
+        try:
+            while len(self.scheduler) or len(self.outbound):
+                self.scheduler.run_due(self.send_message)
+                self.outbound.flush(sc.rtm_send_message)
+                waits = [wait for wait in (self.scheduler.next_due(), self.outbound.next_ready()) if wait is not None]
+                if not waits or time.time() + min(waits) > deadline:
+                    break
+                time.sleep(min(waits))
+        except self.CONNECTION_ERRORS as e:
+            logger.error("Could not send the remaining messages: {e}".format(e=e))
+        return len(self.scheduler) + len(self.outbound)
+
+    def reconnect(self, sc, deadline=None):
+        """
+        Reconnects to RTM after the connection dropped, waiting a jittered, doubling delay before every attempt.
+        RTM does not deliver the events sent while disconnected, so once reconnected the channel members are
+        forgotten, to be fetched again on next use, and a loaded user directory is reconciled with Slack.
+
+        :param sc: SlackClient used to connect to server
+        :param deadline: (float) time after which to stop trying; None for no deadline
+        :return: (bool) True if reconnected, False if reconnect_attempts ran out or the deadline passed
+        """
+        failures = 0
+        while self.reconnect_attempts is None or failures < self.reconnect_attempts:
+            delay = backoff_delay(failures + 1, self.reconnect_backoff, self.max_reconnect_backoff, jitter=0.5)
+            if deadline is not None and time.time() + delay > deadline:
+                break
+            logger.info("RTM connection lost. Reconnecting in {d:.1f}s.".format(d=delay))
+            time.sleep(delay)
+            try:
+                if sc.rtm_connect(with_team_state=False):
+                    self.throughput['reconnects'] += 1
+                    logger.info("Reconnected to RTM after {n} failed attempts.".format(n=failures))
+                    self.memberships.clear()
+                    if self.user_directory.loaded and self._user_events is None:
+                        self.reconcile(sc)
+                    return True
+            except Exception as e:
+                logger.error("Could not reconnect to RTM: {e}".format(e=e))
+            failures += 1
+        logger.error("Giving up on the RTM connection after {n} failed reconnects.".format(n=failures))
+        return False
+
+    def is_duplicate(self, event):
+        """
+        Remembers the (channel, ts) of each event in a bounded LRU window, to spot events delivered twice
+
+        :param event: (dict) normalised RTM event
+        :return: (bool) True if the event was already handled; events without a channel and ts never are
+        """
+        channel, ts = event.get('channel'), event.get('ts')
+        if ts is None or not isinstance(channel, str):
+            return False
+        key = (channel, ts)
+        if key in self.seen_events:
+            return True
+        self.seen_events.set(key, True)
+        return False
+
+    @classmethod
+    def dependencies(cls, handler_flags):
+        """
+        :param handler_flags: (dict) handler flags
+        :return: (list) optional modules the enabled utilities need
+        """
+        modules = set()
+        for flg in cls.DEPENDENCIES:
+            # gifs are only sent by random_reply
+            if handler_flags.get(flg) and (flg != 'random_gif_flg' or handler_flags.get('random_reply_flg')):
+                modules.update(cls.DEPENDENCIES[flg])
+        return sorted(modules)
+
+    @classmethod
+    def load_dependencies(cls, handler_flags):
+        """
+        Imports the optional modules the enabled utilities need, so the first event does not wait on the import.
+        Modules for disabled utilities are never imported.
+
+        :param handler_flags: (dict) handler flags
+        :return: (list) modules imported
+        """
+        loaded = []
+        for module in cls.dependencies(handler_flags):
+            start = time.time()
+            try:
+                importlib.import_module(module)
+            except ImportError as e:
+                logger.error("Could not import {m}, needed by the enabled utilities: {e}".format(m=module, e=e))
+                continue
+            loaded.append(module)
+            logger.debug("Imported {m} in {t:.3f}s.".format(m=module, t=time.time() - start))
+        return loaded
+
+    def read_state(self):
+        """
+        Reads the warm start snapshot
+
+        :return: (dict) snapshot with users, channel_types and gifs, or None if there is no usable snapshot
+        """
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            logger.debug("No handler snapshot found at {p}.".format(p=self.state_path))
+            return None
+
+        if state.get('version') != self.STATE_VERSION:
+            logger.debug("Ignoring handler snapshot with version {v}.".format(v=state.get('version')))
+            return None
+        logger.debug("Loaded handler snapshot saved at {t}.".format(t=time.ctime(state['saved'])))
+        return state
+
+    def save_state(self):
+        """
+        Writes the user directory, channel types, gif cache, dedup window and unsent messages to the warm start
+        snapshot, replacing the file atomically. The bad word list keeps its own snapshot.
+        :return: None
+        """
+        state = {
+            'version': self.STATE_VERSION,
+            'saved': time.time(),
+            'users': self.user_directory.dump(),
+            'channel_types': self.channel_types.dump(),
+            'gifs': self.gifs.dump(),
+            'seen_events': self.seen_events.dump(),
+            'outbound': self.outbound.dump(),
+            'scheduled': self.scheduler.dump()
+        }
+        directory = os.path.dirname(self.state_path)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory or None, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, self.state_path)
+            logger.debug("Saved handler snapshot to {p}.".format(p=self.state_path))
+        except (IOError, OSError) as e:
+            logger.error("Could not save handler snapshot: {e}".format(e=e))
+
+    def reconcile(self, sc):
+        """
+        Fetches users.list and conversations.list on a background thread.
+        The results are swapped in by apply_reconciled() on the event loop, so events never see a half loaded
+        directory.
+
+        :param sc: SlackClient used to connect to server
+        :return: None
+        """
+        # user events handled while fetching are replayed onto the new directory
+        self._user_events = []
+
+        def fetch():
+            # always hands a result to apply_reconciled(), so the user events stop being recorded even on failure
+            directory, channel_types = None, None
+            try:
+                users = UserDirectory()
+                try:
+                    users.load(sc)
+                    directory = users
+                except exceptions.SlackApiException as e:
+                    logger.error(e.message)
+                conversations = ChannelTypeCache()
+                conversations.load(sc)
+                channel_types = conversations
+            except Exception as e:
+                logger.error("Could not reconcile with Slack: {e}".format(e=e))
+            finally:
+                self._reconciled = (directory, channel_types)
+
+        thread = threading.Thread(target=fetch, name='reconcile')
+        thread.daemon = True
+        thread.start()
+
+    def apply_reconciled(self):
+        """
+        Swaps in the users and conversations fetched by reconcile(), once they are ready.
+        Whatever could not be fetched is left as it was.
+        :return: (bool) True if reconcile() finished, whether or not anything was fetched
+        """
+        reconciled = self._reconciled
+        if reconciled is None:
+            return False
+        self._reconciled = None
+
+        directory, channel_types = reconciled
+        if directory is not None:
+            for event in self._user_events:
+                directory.apply_event(event)
+            self.user_directory = directory
+            if self.users_all:
+                self.users = list(directory.ids)
+        self._user_events = None
+        if channel_types is not None:
+            # channels learnt from events since the snapshot are kept
+            self.channel_types.restore(channel_types.dump())
+        logger.debug("Reconciled {u} users and {c} conversations with Slack.".format(
+            u=len(self.user_directory.ids), c=len(self.channel_types.cache)))
+        return True
+
+    def get_metrics(self):
+        """
+        Returns latency histograms and call counts for every utility (utility.<name>), every Web API method
+        (api.<method>) and outbound sends (send)
+        :return: (dict) key to count, total, mean, max, p50, p90 and p99 in seconds, plus 'elapsed'
+        """
+        return self.metrics.snapshot()
+
+    def dump_metrics(self, force=False):
+        """
+        Logs the metrics table every metrics_interval seconds
+        :param force: (bool) log now, regardless of the interval
+        :return: (bool) True if the metrics were logged
+        """
+        now = time.time()
+        if not force:
+            if self.metrics_interval is None:
+                return False
+            if self._next_metrics_dump is None:
+                self._next_metrics_dump = now + self.metrics_interval
+            if now < self._next_metrics_dump:
+                return False
+        self._next_metrics_dump = now + (self.metrics_interval or 0)
+        logger.info(self.metrics.format())
+        return True
+
+    def send_message(self, channel, message, event=None):
+        """
+        Queues a message on the outbound queue. The event loop sends it within the channel's rate limit.
+
+        :param channel: (str) channel to send to
+        :param message: (str) message text
+        :param event: (dict) event being answered; waiting replies to the same event in the same channel are
+            sent as a single post
+        :return: (bool) False if the outbound queue was full and the message was dropped
+        """
+        # ts is only unique within a channel, and replies to an event may go to another channel (i.e. stay_channel)
+        key = (event.get('channel'), event.get('ts')) if event else None
+        return self.outbound.put(channel, message, key)
+
+    def idle(self):
+        """
+        Waits after an empty read, for poll_interval or until the next scheduled or rate limited message is due
+        :return: None
+        """
+        wait = self.poll_interval
+        for next_due in (self.scheduler.next_due(), self.outbound.next_ready()):
+            if next_due is not None:
+                wait = min(wait, next_due)
+        if wait > 0:
+            time.sleep(wait)
+
+    def prefetch_gifs(self):
+        """
+        Warms the gif cache in the background for every gif the enabled utilities can send
+        :return: (list) futures for the prefetched queries
+        """
+        futures = []
+        if self.handler_flags['random_reply_flg'] and self.handler_flags['random_gif_flg']:
+            futures += self.gifs.prefetch(self.responses)
+        if self.handler_flags['magic_eight_flg']:
+            futures += self.gifs.prefetch([self.MAGIC_EIGHT_QUERY], limit=self.MAGIC_EIGHT_TOP)
+        return futures
+
+    def handle_events(self, sc, events):
+        """
+        Drains a batch of RTM frames, handling each one as its own event, and updates the throughput counters
+
+        :param sc: SlackClient used to connect to server
+        :param events: (list) batch of frames returned by rtm_read()
+        :return: (int) number of events handled from the batch
+        """
+        batch_start = time.time()
+        handled = 0
+        for frame in events:
+            event = self.normalize_event(frame)
+            if event is None:
+                logger.debug("Ignore this frame: " + str(frame))
+                continue
+            if self.is_duplicate(event):
+                logger.debug("Already handled this event: " + str(frame))
+                self.throughput['duplicates'] += 1
+                continue
+            self.handle_event(sc, event)
+            handled += 1
+
+        batch_time = time.time() - batch_start
+        self.throughput['batches'] += 1
+        self.throughput['events'] += handled
+        self.throughput['busy_seconds'] += batch_time
+        self.throughput['last_batch_size'] = handled
+        self.throughput['last_batch_seconds'] = batch_time
+        self.throughput['max_batch_size'] = max(self.throughput['max_batch_size'], handled)
+        logger.debug("Handled batch of {n} events in {t:.3f}s ({r:.1f} events/sec sustained)".
+                     format(n=handled, t=batch_time, r=self.get_throughput()['events_per_sec']))
+        return handled
+
+    def handle_event(self, sc, event):
+        """
+        Runs every enabled utility on a single event, if the event is within the handler's run_level
+
+        :param sc: SlackClient used to connect to server
+        :param event: (dict) single normalised RTM event
+        :return: None
+        """
+        try:
+            logger.debug(event)
+            # conversation and user bookkeeping events carry no message for the utilities
+            if self.channel_types.apply_event(event) or self.memberships.apply_event(event):
+                return
+            if self.user_directory.apply_event(event):
+                if self._user_events is not None:
+                    self._user_events.append(event)
+                return
+
+            handlers = self.router.route(event)
+            if not handlers:
+                # no utility subscribes to this event type, i.e. typing, presence_change or hello
+                self.throughput['unrouted'] += 1
+                return
+
+            # msg_type, the text and the other facts are computed on first use and shared by every utility;
+            # with run_level 'All' the message type is only looked up if a utility asks for it
+            ctx = EventContext(self, sc, event)
+            if self.run_level == 'All' or \
+                (self.run_level == 'DM Only' and ctx.msg_type == 'IM') or \
+                    (self.run_level == 'Private' and ctx.msg_type != 'Public'):
+
+                # if message is in correct scope, perform designated tasks
+                if self.io is None:
+                    self.run_handlers(handlers, sc, event, ctx)
+                else:
+                    # network bound utilities go to the pool, so a slow request does not hold up later events
+                    inline = [h for h in handlers if h.__name__ not in self.IO_UTILITIES]
+                    pooled = [h for h in handlers if h.__name__ in self.IO_UTILITIES]
+                    self.run_handlers(inline, sc, event, ctx)
+                    if pooled:
+                        self.io.submit(event.get('channel'), self.run_handlers, pooled, sc, event, ctx)
+            else:
+                logger.debug("Message not in scope.")
+
+        except KeyError:
+            logger.debug("Ignore this event: " + str(event))
+
+    def run_handlers(self, handlers, sc, event, ctx):
+        """
+        Runs utilities on an event one after another, timing each of them
+
+        :param handlers: utilities to run
+        :param sc: SlackClient used to connect to server
+        :param event: (dict) single normalised RTM event
+        :param ctx: (EventContext) shared, lazily computed facts about the event
+        :return: None
+        """
+        try:
+            for handler in handlers:
+                start = time.time()
+                try:
+                    handler(sc, event, ctx)
+                finally:
+                    self.metrics.record('utility.' + handler.__name__, time.time() - start)
+        except KeyError:
+            logger.debug("Ignore this event: " + str(event))
+
+    @staticmethod
+    def normalize_event(frame):
+        """
+        Turns a raw RTM frame into an event object for the utilities
+
+        :param frame: single frame from an rtm_read() batch
+        :return: (dict) copy of the frame, or None if the frame is not an event
+        """
+        if not isinstance(frame, dict):
+            return None
+        return dict(frame)
+
+    def reset_throughput(self):
+        """
+        Resets the per-batch throughput counters
+        :return: None
+        """
+        self.throughput = {
+            'started': time.time(),
+            'batches': 0,
+            'events': 0,
+            'unrouted': 0,
+            'duplicates': 0,
+            'reconnects': 0,
+            'busy_seconds': 0.0,
+            'last_batch_size': 0,
+            'last_batch_seconds': 0.0,
+            'max_batch_size': 0
+        }
+
+    def get_throughput(self):
+        """
+        Returns the throughput counters along with the sustained event rate since the counters were reset
+        :return: (dict) throughput counters plus events_per_sec and busy_events_per_sec
+        """
+        stats = dict(self.throughput)
+        elapsed = time.time() - stats['started']
+        stats['events_per_sec'] = stats['events'] / elapsed if elapsed > 0 else 0.0
+        stats['busy_events_per_sec'] = stats['events'] / stats['busy_seconds'] if stats['busy_seconds'] > 0 else 0.0
+        return stats
 
     def get_msg_type(self, sc, event):
         """
-        get_msg_type determines if a message event if private, public or an IM
+        get_msg_type determines if a message event if private, public or an IM.
+        Uses the channel type cache, so the Web API is only called for channels it has not seen yet
 
         :param sc: SlackClient used to connect to server
         :param event: event to be handled by the random_reply
         :return: type of message (Public, Private or IM)
         """
-        im_info = sc.api_call("im.info", channel=event[0]['channel'])
-        if 'ok' in im_info.keys() and im_info['ok'] is False:
-            dm_info = sc.api_call("groups.info", channel=event[0]['channel'])
-            if 'ok' in dm_info.keys() and dm_info['ok'] is False:
-                return 'Public'
-            else:
-                return 'Private'
-        else:
-            return 'IM'
+        return self.channel_types.classify(sc, event['channel'])
 
     # Utility Methods
 
+    @subscribe()
     def random_reply(self, sc, event, *args):
         """
         For a given message event,
@@ -510,90 +1065,89 @@ class SlackEventHandler:
 
         try:
             if event and \
-                event[0]['type'] == 'message' and \
-                    (event[0]['user'] in self.users):
+                event['type'] == 'message' and \
+                    (event['user'] in self.users):
                 randint = random.randint(0, len(self.responses) - 1)
 
                 message = self.responses[randint]
                 if self.handler_flags['random_gif_flg']:
-                    g = giphypop.Giphy()
-                    message = "{m}\n{v}".format(
-                        v=[x for x in g.search(message)][0],
-                        m=message)
+                    gif = self.gifs.first(message)
+                    if gif:
+                        message = "{m}\n{v}".format(
+                            v=gif,
+                            m=message)
 
-                sc.rtm_send_message(event[0]['channel'], message)
+                self.send_message(event['channel'], message, event)
 
         except KeyError:
-            if 'type' not in event[0].keys():
+            if 'type' not in event.keys():
                 logger.debug("Don't worry about this one.")
                 logger.debug(event)
             else:
                 raise
 
-    def mark_read(self, sc, event, msg_type, *args):
+    @subscribe()
+    def mark_read(self, sc, event, ctx=None, *args):
         """
         For a given message event, if the event has a user notification tag, but it does not contain the user's name
         mark_read marks the channel as read up to that point
 
         :param sc: SlackClient used to connect to server
         :param event: event to be handled by the mark_read
-        :param msg_type: type of message
+        :param ctx: (EventContext) shared, lazily computed facts about the event
         :return:
         """
         try:
-            if event[0]['type'] == 'message':
-                text = event[0]['text']
+            if event['type'] == 'message':
+                ctx = ctx or EventContext(self, sc, event)
+                text = ctx.text.text
 
                 if find_element_in_string(text, '<') != -1 and \
                         find_element_in_string(text, '>') != -1 and \
                         find_element_in_string(text, sc.server.username) == -1:
+                    msg_type = ctx.msg_type
                     if msg_type == 'IM':
-                        sc.api_call("im.mark", channel=event[0]['channel'], ts=event[0]['ts'])
+                        sc.api_call("im.mark", channel=event['channel'], ts=event['ts'])
                     elif msg_type == 'Private':
-                        sc.api_call("groups.mark", channel=event[0]['channel'], ts=event[0]['ts'])
+                        sc.api_call("groups.mark", channel=event['channel'], ts=event['ts'])
                     else:
-                        sc.api_call("channels.mark", channel=event[0]['channel'], ts=event[0]['ts'])
+                        sc.api_call("channels.mark", channel=event['channel'], ts=event['ts'])
                 else:
                     logger.debug('Don\'t change')
 
         except KeyError:
-            if 'type' not in event[0].keys():
+            if 'type' not in event.keys():
                 logger.debug("Don't worry about this one.")
                 logger.debug(event)
             else:
                 raise
 
-    def someones_talking_about_you(self, sc, event, msg_type, all_users, *args):
+    @subscribe()
+    def someones_talking_about_you(self, sc, event, ctx=None, *args):
         """
         For a given message event, if a user's full name is found in the message text
         someones_talking_about_you sends a message to a notify channel which tags the person talked about,
-        the people in the private channel, and tells the full body of the message
+        the people in the private channel, and tells the full body of the message.
+        Names are found in a single pass over the text with the user directory's full name matcher
 
         :param sc: SlackClient used to connect to server
         :param event: event to be handled by the mark_read
-        :param msg_type: type of message
-        :param all_users: all users in slack environment
+        :param ctx: (EventContext) shared, lazily computed facts about the event
         :return:
         """
 
         try:
-            users_to_notify = []
-
-            if event[0]['type'] == 'message' and msg_type != 'Public':
-                text = event[0]['text']
-                for user in all_users:
-                    if find_element_in_string(text.lower(),
-                                              user['first_name'].lower() + ' ' + user['last_name'].lower()) != -1:
-                        users_to_notify.append(user)
+            if event['type'] == 'message':
+                ctx = ctx or EventContext(self, sc, event)
+                text = ctx.text
+                # names are matched locally first, so the message type is only looked up when someone is mentioned
+                users_to_notify = self.user_directory.mentioned(text.lower)
 
-                if len(users_to_notify) > 0:
+                if len(users_to_notify) > 0 and ctx.msg_type != 'Public':
                     user_ids = [user['id'] for user in users_to_notify]
 
-                    not_all_users_in_convo = False
-                    convo_members = sc.api_call("conversations.members", channel=event[0]['channel'])
-                    for user in user_ids:
-                        if user not in [cv for cv in convo_members['members']]:
-                            not_all_users_in_convo = True
+                    convo_members = ctx.members
+                    not_all_users_in_convo = any(user not in convo_members for user in user_ids)
 
                     if not_all_users_in_convo:
                         message = """Hey <@{u}> 
@@ -604,167 +1158,169 @@ class SlackEventHandler:
                         
                         {t}
                         """.format(u="> <@".join(user_ids),
-                                   c="> <@".join([cv for cv in convo_members['members']]),
-                                   s=event[0]['user'],
-                                   t=text)
+                                   c="> <@".join(sorted(convo_members)),
+                                   s=event['user'],
+                                   t=text.text)
 
-                        sc.rtm_send_message(self.stay_channel, message)
+                        self.send_message(self.stay_channel, message, event)
 
+        except exceptions.SlackApiException as e:
+            logger.error(e.message)
         except KeyError:
-            if 'type' not in event[0].keys():
+            if 'type' not in event.keys():
                 logger.debug("Don't worry about this one.")
                 logger.debug(event)
             else:
                 raise
 
-    def magic_eight(self, sc, event, *args):
+    @subscribe()
+    def magic_eight(self, sc, event, ctx=None, *args):
         """
         For a given message event, if a '?' is found in the message
         magic_eight sends one of the top 10 magic 8 ball gifs from giphy as a message
 
         :param sc: SlackClient used to connect to server
         :param event: event to be handled by the random_reply
+        :param ctx: (EventContext) shared, lazily computed facts about the event
         :return:
         """
         try:
             if event and \
-                event[0]['type'] == 'message' and \
-                    (event[0]['user'] in self.users):
-                randint = random.randint(0, 10)
-                if find_element_in_string(event[0]['text'], '?') >= 0:
-                    g = giphypop.Giphy()
-                    message = "{v}\n".format(v=[x for x in g.search('magic eight ball')][randint])
-                    logger.debug("TEXT: "+event[0]['text'])
-                    sc.rtm_send_message(event[0]['channel'], message)
+                event['type'] == 'message' and \
+                    (event['user'] in self.users):
+                text = (ctx or EventContext(self, sc, event)).text
+                if find_element_in_string(text.text, '?') >= 0:
+                    gif = self.gifs.choice(self.MAGIC_EIGHT_QUERY, top=self.MAGIC_EIGHT_TOP)
+                    if gif:
+                        message = "{v}\n".format(v=gif)
+                        logger.debug("TEXT: "+text.text)
+                        self.send_message(event['channel'], message, event)
+                    else:
+                        logger.debug("No magic eight ball gifs found")
                 else:
                     logger.debug("No question mark found")
 
         except KeyError:
-            if 'type' not in event[0].keys():
+            if 'type' not in event.keys():
                 logger.debug("Don't worry about this one.")
                 logger.debug(event)
             else:
                 raise
 
-    def homophone_suggest(self, sc, event, *args):
+    @subscribe()
+    def homophone_suggest(self, sc, event, ctx=None, *args):
         """
         For a given message event and for every homophone found in the message,
         homophone_suggest sends a message suggesting the opposite homophone
 
         :param sc: SlackClient used to connect to server
         :param event: event to be handled by the random_reply
+        :param ctx: (EventContext) shared, lazily computed facts about the event
         :return: None
         """
         try:
-            text_words = [strip_punctuation(word) for word in
-                          event[0]['text'].lower().split(' ')
-                          if strip_punctuation(word) in self.homophones.keys()]
-
-            for word in text_words:
+            text = (ctx or EventContext(self, sc, event)).text
+            # one pass over the shared message tokens; multi-word homophones are matched as well
+            for word, alternatives in self.homophones.find_in_tokens(text.tokens):
                 message = "Hey <@{u}>!\n\tYou typed {k}, but you probably meant {v}.".\
-                    format(u=event[0]['user'],
+                    format(u=event['user'],
                            k=word,
-                           v=self.homophones[word])
-                sc.rtm_send_message(event[0]['channel'], message)
+                           v=' or '.join(alternatives))
+                self.send_message(event['channel'], message, event)
 
         except KeyError:
-            if 'type' not in event[0].keys():
+            if 'type' not in event.keys():
                 logger.debug("Don't worry about this one.")
                 logger.debug(event)
             else:
                 raise
 
-    def reading_level(self, sc, event, *args):
+    @subscribe()
+    def reading_level(self, sc, event, ctx=None, *args):
         """
         Calculate the reading level of a given comment
         :param sc: SlackClient used to connect to server
         :param event: event to be handled by the method
+        :param ctx: (EventContext) shared, lazily computed facts about the event
         :return:
         """
         try:
-            text = event[0]['text'].lower()
-            sentences = len(re.findall(r'[!?\.]', text))
-            if sentences == 0:
-                sentences = 1
-            words = text.split()
-
-            if len(words) < self.min_words:
+            text = (ctx or EventContext(self, sc, event)).text
+            if len(text.words) < self.min_words:
                 logger.debug("Message too short for reading_level calculation.")
                 return
 
-            syllables = sum([len(re.findall(r'[aeiouy]+', x.rstrip('e'))) for x in words])
-            reading_level = 0.39*(len(words)/sentences) + 11.8*(syllables/len(words)) - 15.59
+            reading_level = reading_utils.grade_level(text.lower)
+            if reading_level is None:
+                return
 
             message = "Your comment has an estimated Flesch-Kincaid grade level of {x}.".\
                 format(x=int(round(reading_level)))
-            sc.rtm_send_message(event[0]['channel'], message)
+            self.send_message(event['channel'], message, event)
 
         except KeyError:
-            if 'type' not in event[0].keys():
+            if 'type' not in event.keys():
                 logger.debug("Don't worry about this one.")
                 logger.debug(event)
             else:
                 raise
 
-    def sing_to_me(self, sc, event, *args):
+    @subscribe()
+    def sing_to_me(self, sc, event, ctx=None, *args):
         """
-        Replies with song lyrics for a popular song on Genius
+        Replies with song lyrics for a popular song on Genius.
+        Songs come from a prefetched pool, and lines are queued on the scheduler one second apart
+        instead of being sent inline
         :param sc: SlackClient used to connect to server
         :param event: event to be handled by the method
+        :param ctx: (EventContext) shared, lazily computed facts about the event
         :return:
         """
         try:
-            text = event[0]['text'].lower()
-            if text == 'sing to me':
-                songs = web_utils.get_top_songs()
-                n = random.randint(0, len(songs)-1)
-                r = web_utils.get_request(songs[n])
-                artist, song = web_utils.get_artist_song(r)
-                lyrics = web_utils.get_lyrics(r)
-                message = "How about {s} by {a}?".format(s=song, a=artist)
-                sc.rtm_send_message(event[0]['channel'], message)
-                time.sleep(1)
-                for i in range(3):
-                    sc.rtm_send_message(event[0]['channel'], '{n}'.format(n=i+1))
-                    time.sleep(1)
-                sc.rtm_send_message(event[0]['channel'], 'Go!')
-                time.sleep(1)
-                sc.rtm_send_message(event[0]['channel'], '')
-
-                for line in lyrics:
-                    time.sleep(1)
-                    sc.rtm_send_message(event[0]['channel'], line)
+            if (ctx or EventContext(self, sc, event)).text.lower == 'sing to me':
+                song = self.songs.get()
+                if song is None:
+                    return
+                message = "How about {s} by {a}?".format(s=song['song'], a=song['artist'])
+
+                # the countdown and lyrics play from the scheduler so the event loop keeps running meanwhile
+                self.scheduler.schedule_sequence(event['channel'],
+                                                 [message, '1', '2', '3', 'Go!', ''] + song['lyrics'],
+                                                 interval=1)
 
         except KeyError:
-            if 'type' not in event[0].keys():
+            if 'type' not in event.keys():
                 logger.debug("Don't worry about this one.")
                 logger.debug(event)
             else:
                 raise
 
-    def clean_your_mouth_with_soap(self, sc, event, *args):
+    @subscribe()
+    def clean_your_mouth_with_soap(self, sc, event, ctx=None, *args):
         """
-        If it finds any of the stored bad words, reprimands user who sent message
+        If it finds any of the stored bad words, reprimands user who sent message.
+        Obfuscated bad words such as "d.a.r.n" or "h3ck" count too.
         :param sc: SlackClient used to connect to server
         :param event: event to be handled by the method
+        :param ctx: (EventContext) shared, lazily computed facts about the event
         :return:
         """
         try:
-            text = event[0]['text'].lower().split()
-            clean = False
-            for word in text:
-                if word in self.bad_words:
-                    clean = True
-                    break
-            if clean:
+            text = (ctx or EventContext(self, sc, event)).text
+            # a refreshed BadWordList swaps in a new matcher along with its words
+            matcher = self.bad_words.matcher if isinstance(self.bad_words, BadWordList) else self.bad_word_matcher
+            match = matcher.search(text.text)
+            if match:
+                logger.debug("Found {w} at {s}:{e} in message from {u}".format(w=match[2], s=match[0], e=match[1],
+                                                                             u=event.get('user')))
                 message = "You kiss your mother with that mouth?\nClean it with soap!"
-                sc.rtm_send_message(event[0]['channel'], message)
+                self.send_message(event['channel'], message, event)
 
                 gif_url = 'https://giphy.com/gifs/Rs05vfoiXpIOc/html5'
-                sc.rtm_send_message(event[0]['channel'], '{v}\n'.format(v=gif_url))
+                self.send_message(event['channel'], '{v}\n'.format(v=gif_url), event)
 
         except KeyError:
-            if 'type' not in event[0].keys():
+            if 'type' not in event.keys():
                 logger.debug("Don't worry about this one.")
                 logger.debug(event)
             else:
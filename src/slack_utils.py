@@ -0,0 +1,486 @@
+import logging
+import threading
+import time
+
+from src.cache_utils import TTLCache
+from src.match_utils import AhoCorasick
+from src import exceptions
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+def paginate(sc, method, key, limit=200, **kwargs):
+    """
+    Streams the items of a cursor-paginated Slack Web API method, one page at a time
+
+    :param sc: SlackClient used to connect to server
+    :param method: (str) API method to call, i.e. conversations.list
+    :param key: (str) key in the response holding the list of items, i.e. channels
+    :param limit: (int) page size requested from Slack
+    :param kwargs: additional arguments passed to the API method
+    :return: generator of items
+    :raises SlackApiException: if a page does not come back ok
+    """
+    cursor = None
+    while True:
+        if cursor:
+            response = sc.api_call(method, limit=limit, cursor=cursor, **kwargs)
+        else:
+            response = sc.api_call(method, limit=limit, **kwargs)
+
+        if not response.get('ok', True):
+            raise exceptions.SlackApiException(method, response.get('error'))
+
+        for item in response.get(key, []):
+            yield item
+
+        cursor = response.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return
+
+
+class ChannelTypeCache:
+    """
+    Maps channel IDs to their message type (IM, Private or Public) so classifying an event is a dict lookup.
+    Seeded from conversations.list at connect time and kept current from RTM events.
+    """
+
+    # RTM events that announce a new conversation, and the type of that conversation
+    EVENT_TYPES = {
+        'channel_created': 'Public',
+        'channel_joined': 'Public',
+        'group_joined': 'Private',
+        'im_created': 'IM',
+        'mpim_joined': 'Private'
+    }
+
+    def __init__(self, max_size=10000, ttl=6 * 60 * 60):
+        """
+        :param max_size: (int) maximum number of channels kept in the cache
+        :param ttl: (float) seconds before a cached classification is looked up again
+        """
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    @staticmethod
+    def conversation_type(conversation):
+        """
+        Classifies a conversation object returned by the conversations API
+
+        :param conversation: (dict) conversation object
+        :return: type of conversation (Public, Private or IM)
+        """
+        if conversation.get('is_im'):
+            return 'IM'
+        elif conversation.get('is_private') or conversation.get('is_group') or conversation.get('is_mpim'):
+            return 'Private'
+        else:
+            return 'Public'
+
+    def load(self, sc):
+        """
+        Seeds the cache with every conversation the client can see
+
+        :param sc: SlackClient used to connect to server
+        :return: (int) number of conversations classified
+        """
+        count = 0
+        try:
+            for conversation in paginate(sc, "conversations.list", 'channels', limit=1000,
+                                         types='public_channel,private_channel,mpim,im', exclude_archived=True):
+                self.cache.set(conversation['id'], self.conversation_type(conversation))
+                count += 1
+        except exceptions.SlackApiException as e:
+            # unclassified channels fall back to lookup() when they are first seen
+            logger.error(e.message)
+        logger.debug("Classified {n} conversations.".format(n=count))
+        return count
+
+    def dump(self):
+        """
+        :return: (list) cached classifications with their expiry times, JSON serialisable, for restore()
+        """
+        return self.cache.dump()
+
+    def restore(self, entries):
+        """
+        Adds classifications from a previous dump(), or from another cache's dump(); expired ones are skipped
+
+        :param entries: (list) result of dump()
+        :return: (int) number of channels restored
+        """
+        return self.cache.restore(entries)
+
+    def apply_event(self, event):
+        """
+        Updates the cache from an RTM event that creates or joins a conversation
+
+        :param event: (dict) RTM event
+        :return: (bool) True if the event updated the cache
+        """
+        msg_type = self.EVENT_TYPES.get(event.get('type'))
+        if msg_type is None:
+            return False
+
+        channel = event.get('channel')
+        if isinstance(channel, dict):
+            channel = channel.get('id')
+        if not channel:
+            return False
+
+        self.cache.set(channel, msg_type)
+        return True
+
+    def classify(self, sc, channel):
+        """
+        Returns the message type for a channel, asking Slack only if the channel is not cached
+
+        :param sc: SlackClient used to connect to server
+        :param channel: (str) channel ID
+        :return: type of message (Public, Private or IM)
+        """
+        msg_type = self.cache.get(channel)
+        if msg_type is None:
+            msg_type = self.lookup(sc, channel)
+            self.cache.set(channel, msg_type)
+        return msg_type
+
+    @staticmethod
+    def lookup(sc, channel):
+        """
+        Classifies a channel through the Web API
+
+        :param sc: SlackClient used to connect to server
+        :param channel: (str) channel ID
+        :return: type of message (Public, Private or IM)
+        """
+        im_info = sc.api_call("im.info", channel=channel)
+        if 'ok' in im_info.keys() and im_info['ok'] is False:
+            dm_info = sc.api_call("groups.info", channel=channel)
+            if 'ok' in dm_info.keys() and dm_info['ok'] is False:
+                return 'Public'
+            else:
+                return 'Private'
+        else:
+            return 'IM'
+
+
+class MembershipIndex:
+    """
+    In-memory index of conversation members (channel ID -> set of user IDs).
+    Channels are fetched lazily on first use and kept current from member_joined_channel/member_left_channel events.
+    Readers get a frozen copy of a channel's members, so the event loop can keep updating the index while utility
+    threads use them.
+    """
+
+    def __init__(self, max_channels=5000):
+        """
+        :param max_channels: (int) maximum number of channels kept; the least recently used channel is evicted first
+        """
+        self.channels = TTLCache(max_size=max_channels)
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """
+        Forgets every channel, i.e. when membership events may have been missed; channels are fetched again on next use
+        :return: None
+        """
+        with self._lock:
+            self.channels.clear()
+
+    def members(self, sc, channel):
+        """
+        Returns the members of a channel, fetching them from Slack the first time the channel is seen
+
+        :param sc: SlackClient used to connect to server
+        :param channel: (str) channel ID
+        :return: (frozenset) user IDs of the channel members
+        :raises SlackApiException: if the members could not be fetched
+        """
+        with self._lock:
+            members = self.channels.get(channel)
+            if members is not None:
+                return frozenset(members)
+
+        # fetched without holding the lock; membership events for the channel are only applied once it is cached
+        fetched = set(paginate(sc, "conversations.members", 'members', channel=channel))
+        with self._lock:
+            members = self.channels.get(channel)
+            if members is None:
+                members = fetched
+                self.channels.set(channel, members)
+            return frozenset(members)
+
+    def apply_event(self, event):
+        """
+        Updates the index from a member_joined_channel or member_left_channel event.
+        Channels that have not been fetched yet are left alone; they are fetched in full when first needed.
+
+        :param event: (dict) RTM event
+        :return: (bool) True if the event was a membership event
+        """
+        event_type = event.get('type')
+        if event_type not in ('member_joined_channel', 'member_left_channel'):
+            return False
+
+        with self._lock:
+            members = self.channels.get(event.get('channel'))
+            if members is not None:
+                if event_type == 'member_joined_channel':
+                    members.add(event['user'])
+                else:
+                    members.discard(event['user'])
+        return True
+
+
+class UserDirectory:
+    """
+    Indexed copy of the workspace user list.
+    Loaded page by page from users.list and kept current from team_join/user_change events, so lookups by ID,
+    username, first name, last name or full name in a message never go back to Slack.
+    Updates and lookups hold a lock, so the event loop can apply user events while utility threads search.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.ids = None
+        self.users = None
+        self.loaded = False
+        self._id_pos = None
+        self._user_pos = None
+        self._by_id = None
+        self._by_name = None
+        self._by_first_name = None
+        self._by_last_name = None
+        self._name_matcher = None
+        self.clear()
+
+    def clear(self):
+        """
+        Empties the directory
+        :return: None
+        """
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self.ids = []
+        self.users = []
+        self.loaded = False
+        self._id_pos = {}
+        self._user_pos = {}
+        self._by_id = {}
+        self._by_name = {}
+        self._by_first_name = {}
+        self._by_last_name = {}
+        self._name_matcher = AhoCorasick()
+
+    @staticmethod
+    def summarize(member):
+        """
+        Reduces a Slack user object to the fields the utilities use
+
+        :param member: (dict) user object from users.list or a user event
+        :return: (dict) name, id, first_name and last_name, or None if the profile has no first and last name
+        """
+        profile = member.get('profile', {})
+        if 'first_name' not in profile.keys() or 'last_name' not in profile.keys():
+            return None
+        return {
+            'name': member['name'],
+            'id': member['id'],
+            'first_name': profile['first_name'],
+            'last_name': profile['last_name']
+        }
+
+    @staticmethod
+    def full_name(user):
+        """
+        :param user: (dict) user summary
+        :return: (str) lowercase first and last name, as looked for in message text
+        """
+        return user['first_name'].lower() + ' ' + user['last_name'].lower()
+
+    def load(self, sc):
+        """
+        Replaces the directory with the current users.list, streamed one page at a time
+
+        :param sc: SlackClient used to connect to server
+        :return: (int) number of members loaded
+        :raises SlackApiException: if users.list fails
+        """
+        self.clear()
+        for member in paginate(sc, "users.list", 'members'):
+            self.apply_user(member)
+        self.loaded = True
+        logger.debug("Loaded {n} users.".format(n=len(self.ids)))
+        return len(self.ids)
+
+    def dump(self):
+        """
+        :return: (dict) ids and user summaries, JSON serialisable, for restore()
+        """
+        with self._lock:
+            return {'ids': list(self.ids), 'users': list(self.users)}
+
+    def restore(self, state):
+        """
+        Replaces the directory with a previous dump()
+
+        :param state: (dict) ids and user summaries
+        :return: (int) number of members restored
+        """
+        with self._lock:
+            self._clear()
+            for user_id in state['ids']:
+                self._id_pos[user_id] = len(self.ids)
+                self.ids.append(user_id)
+            for user in state['users']:
+                self._add_user(user)
+            self.loaded = True
+        logger.debug("Restored {n} users.".format(n=len(self.ids)))
+        return len(self.ids)
+
+    def apply_event(self, event):
+        """
+        Updates the directory from a team_join or user_change event
+
+        :param event: (dict) RTM event
+        :return: (bool) True if the event was a user event
+        """
+        if event.get('type') not in ('team_join', 'user_change'):
+            return False
+        self.apply_user(event['user'])
+        return True
+
+    def apply_user(self, member):
+        """
+        Adds a member to the directory, or replaces their previous entry
+
+        :param member: (dict) user object from users.list or a user event
+        :return: None
+        """
+        user = self.summarize(member)
+        with self._lock:
+            if member['id'] not in self._id_pos:
+                self._id_pos[member['id']] = len(self.ids)
+                self.ids.append(member['id'])
+
+            self._remove_user(member['id'])
+            if user is not None:
+                self._add_user(user)
+
+    def _add_user(self, user):
+        self._user_pos[user['id']] = len(self.users)
+        self.users.append(user)
+        self._by_id[user['id']] = user
+        self._index(self._by_name, user['name'], user['id'])
+        self._index(self._by_first_name, user['first_name'], user['id'])
+        self._index(self._by_last_name, user['last_name'], user['id'])
+        if self.full_name(user).strip():
+            self._name_matcher.add(self.full_name(user), user['id'])
+
+    def _remove_user(self, user_id):
+        user = self._by_id.pop(user_id, None)
+        if user is None:
+            return
+
+        # swap the last user into the removed slot so removal stays O(1)
+        pos = self._user_pos.pop(user_id)
+        last = self.users.pop()
+        if last['id'] != user_id:
+            self.users[pos] = last
+            self._user_pos[last['id']] = pos
+
+        self._unindex(self._by_name, user['name'], user_id)
+        self._unindex(self._by_first_name, user['first_name'], user_id)
+        self._unindex(self._by_last_name, user['last_name'], user_id)
+        self._name_matcher.remove(self.full_name(user), user_id)
+
+    @staticmethod
+    def _index(index, key, user_id):
+        index.setdefault(key.lower(), set()).add(user_id)
+
+    @staticmethod
+    def _unindex(index, key, user_id):
+        ids = index.get(key.lower())
+        if ids is not None:
+            ids.discard(user_id)
+            if not ids:
+                del index[key.lower()]
+
+    def get(self, user_id):
+        """
+        :param user_id: (str) user ID
+        :return: (dict) user summary, or None if the user has no first and last name
+        """
+        return self._by_id.get(user_id)
+
+    def search(self, username=None, first_name=None, last_name=None):
+        """
+        Look up users by their username, first name and/or last name, ignoring case.
+        Username takes precedence over the other arguments.
+
+        :param username: (str) Slack username
+        :param first_name: (str) first name
+        :param last_name: (str) last name
+        :return: list of matching user summaries
+        """
+        with self._lock:
+            if username:
+                ids = self._by_name.get(username.lower(), set())
+            elif first_name and last_name:
+                ids = self._by_first_name.get(first_name.lower(), set()) & \
+                    self._by_last_name.get(last_name.lower(), set())
+            elif first_name:
+                ids = self._by_first_name.get(first_name.lower(), set())
+            elif last_name:
+                ids = self._by_last_name.get(last_name.lower(), set())
+            else:
+                ids = set()
+            return [self._by_id[user_id] for user_id in sorted(ids, key=self._user_pos.get)]
+
+    def mentioned(self, text):
+        """
+        Finds every user whose full name appears in the text, in a single pass
+
+        :param text: (str) message text
+        :return: list of user summaries, in the order they appear in the directory
+        """
+        # the matcher rebuilds its failure links lazily on the first search after a change, so this holds the lock too
+        with self._lock:
+            ids = self._name_matcher.find_all(text.lower())
+            return [self._by_id[user_id] for user_id in sorted(ids, key=self._user_pos.get)]
+
+
+class InstrumentedClient:
+    """
+    Wraps a SlackClient so every Web API call is timed under api.<method> and every outbound message under send.
+    Everything else is passed through to the wrapped client.
+    """
+
+    def __init__(self, sc, metrics):
+        """
+        :param sc: SlackClient to wrap
+        :param metrics: (Metrics) where the timings go
+        """
+        self.sc = sc
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.sc, name)
+
+    def api_call(self, method, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.sc.api_call(method, *args, **kwargs)
+        finally:
+            self.metrics.record('api.' + method, time.time() - start)
+
+    def rtm_send_message(self, channel, message, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.sc.rtm_send_message(channel, message, *args, **kwargs)
+        finally:
+            self.metrics.record('send', time.time() - start)
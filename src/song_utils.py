@@ -0,0 +1,118 @@
+import logging
+import random
+import threading
+from collections import deque
+
+from src import web_utils
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+class SongPool:
+    """
+    Small pool of ready-to-sing songs from Genius, kept full by a background prefetch thread until stop() is called.
+    """
+
+    def __init__(self, size=3, retry_interval=60):
+        """
+        :param size: (int) number of songs kept ready
+        :param retry_interval: (float) seconds the prefetcher waits after a failed fetch
+        """
+        self.size = size
+        self.retry_interval = retry_interval
+        self._songs = deque()
+        self._lock = threading.Lock()
+        self._wanted = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._songs)
+
+    def start(self):
+        """
+        Starts the background prefetcher, if it is not already running
+        :return: None
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._wanted.set()
+            self._thread = threading.Thread(target=self._run, name='song-prefetch')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the background prefetcher, once a fetch in progress has finished
+
+        :param timeout: (float) seconds to wait for the prefetcher at most; None to wait indefinitely
+        :return: (bool) True if the prefetcher is not running
+        """
+        thread = self._thread
+        if thread is None:
+            return True
+        # set under the lock, so the prefetcher cannot clear _wanted after the wake-up and sleep for good
+        with self._lock:
+            self._stopping.set()
+            self._wanted.set()
+        thread.join(timeout)
+        return not thread.is_alive()
+
+    def get(self):
+        """
+        Takes a song out of the pool, fetching one directly if the pool is empty
+
+        :return: dict with url, artist, song and lyrics, or None if no song could be fetched
+        """
+        with self._lock:
+            song = self._songs.popleft() if self._songs else None
+        self._wanted.set()
+
+        if song is None:
+            logger.debug("Song pool empty. Fetching a song directly.")
+            try:
+                song = self.fetch()
+            except Exception as e:
+                logger.error("Could not fetch a song: {e}".format(e=e))
+        return song
+
+    def fetch(self):
+        """
+        Fetches a random popular song that is not already waiting in the pool
+
+        :return: dict with url, artist, song and lyrics
+        """
+        songs = web_utils.get_top_songs()
+        with self._lock:
+            ready = set(song['url'] for song in self._songs)
+        choices = [url for url in songs if url not in ready] or songs
+        return web_utils.get_song(random.choice(choices))
+
+    def _run(self):
+        while True:
+            self._wanted.wait()
+            if self._stopping.is_set():
+                return
+            with self._lock:
+                full = len(self._songs) >= self.size
+                if full and not self._stopping.is_set():
+                    self._wanted.clear()
+            if full:
+                continue
+
+            try:
+                song = self.fetch()
+            except Exception as e:
+                logger.error("Could not prefetch a song: {e}".format(e=e))
+                with self._lock:
+                    if not self._stopping.is_set():
+                        self._wanted.clear()
+                # try again when a song is taken, or after retry_interval
+                self._wanted.wait(self.retry_interval)
+                self._wanted.set()
+                continue
+
+            with self._lock:
+                self._songs.append(song)
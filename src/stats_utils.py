@@ -0,0 +1,174 @@
+import bisect
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+def percentile(samples, p):
+    """
+    Nearest-rank percentile of a list of samples
+
+    :param samples: (list) sorted samples
+    :param p: (float) percentile, between 0 and 100
+    :return: sample at the percentile, or None if there are no samples
+    """
+    if not samples:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(samples))) - 1
+    return samples[min(max(rank, 0), len(samples) - 1)]
+
+
+class LatencyRecorder:
+    """
+    Keeps every latency sample per key, for exact percentiles over a bounded run such as a replay
+    """
+
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, seconds):
+        """
+        :param key: (str) name of what was timed
+        :param seconds: (float) time taken
+        :return: None
+        """
+        with self._lock:
+            self.samples.setdefault(key, []).append(seconds)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+        :param percentiles: percentiles to report
+        :return: dict of key to count, total, mean, max and the requested percentiles, all in seconds
+        """
+        with self._lock:
+            samples = dict((key, sorted(self.samples[key])) for key in self.samples)
+
+        summary = {}
+        for key in samples:
+            values = samples[key]
+            stats = {
+                'count': len(values),
+                'total': sum(values),
+                'mean': sum(values) / len(values),
+                'max': values[-1]
+            }
+            for p in percentiles:
+                stats['p{p}'.format(p=p)] = percentile(values, p)
+            summary[key] = stats
+        return summary
+
+
+class LatencyHistogram:
+    """
+    Fixed-size latency histogram with exponential buckets, from 0.1ms doubling up to about a minute
+    """
+
+    BOUNDS = tuple(0.0001 * 2 ** i for i in range(20))
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """
+        :param seconds: (float) time taken
+        :return: None
+        """
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+        :param p: (float) percentile, between 0 and 100
+        :return: (float) upper bound of the bucket holding the percentile (capped at the max seen), or None
+        """
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(p / 100.0 * self.count)), 1)
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+        :param percentiles: percentiles to report
+        :return: dict with count, total, mean, max and the requested percentiles, in seconds
+        """
+        stats = {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max
+        }
+        for p in percentiles:
+            stats['p{p}'.format(p=p)] = self.percentile(p)
+        return stats
+
+
+class Metrics:
+    """
+    Thread-safe registry of latency histograms and call counts, keyed by name, i.e. utility.reading_level or
+    api.im.info
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, key, seconds):
+        """
+        :param key: (str) name of what was timed
+        :param seconds: (float) time taken
+        :return: None
+        """
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def snapshot(self):
+        """
+        :return: dict of key to count, total, mean, max, p50, p90 and p99 (seconds), plus elapsed seconds since
+            the metrics were started under the key 'elapsed'
+        """
+        with self._lock:
+            snapshot = dict((key, self.histograms[key].summary()) for key in self.histograms)
+        snapshot['elapsed'] = time.time() - self.started
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.started = time.time()
+
+    def format(self):
+        """
+        :return: (str) table of every key, most total time first
+        """
+        snapshot = self.snapshot()
+        elapsed = snapshot.pop('elapsed')
+        lines = ["Metrics over {s:.0f}s".format(s=elapsed),
+                 "{k:<40} {n:>8} {t:>10} {p50:>9} {p99:>9} {mx:>9}".format(
+                     k='key', n='calls', t='total s', p50='p50 ms', p99='p99 ms', mx='max ms')]
+        for key in sorted(snapshot, key=lambda k: -snapshot[k]['total']):
+            stats = snapshot[key]
+            lines.append("{k:<40} {n:>8} {t:>10.3f} {p50:>9.2f} {p99:>9.2f} {mx:>9.2f}".format(
+                k=key, n=stats['count'], t=stats['total'], p50=stats['p50'] * 1000, p99=stats['p99'] * 1000,
+                mx=stats['max'] * 1000))
+        return '\n'.join(lines)
@@ -1,5 +1,7 @@
 import string
 
+PUNCTUATION = string.punctuation
+
 def find_element_in_string(s, e):
     """
     Returns -1 instead of ValueError for index()
@@ -18,13 +20,81 @@ def find_element_in_string(s, e):
 
 def strip_punctuation(s):
     """
-    Removes all punctuation marks from the ends of a string
+    Removes all punctuation marks from the ends of a string, in a single pass
 
     :param s: (str) string to be stripped
     :return: string with all punctuation marks stripped off the sides
     """
+    return s.strip(PUNCTUATION)
+
+
+def to_token(word):
+    """
+    Strips punctuation off the sides of a word, like strip_punctuation, but keeps a hyphen that ends the word,
+    i.e. "ante-," becomes "ante-"
+
+    :param word: (str) word without whitespace
+    :return: (str) token, empty if the word was only punctuation
+    """
+    token = strip_punctuation(word)
+    if token and '-' in word:
+        end = word.find(token) + len(token)
+        if word[end:end + 1] == '-':
+            token += '-'
+    return token
+
+
+class TextAnalysis:
+    """
+    Normalised forms of a message's text, computed on first use and shared by every utility handling the event.
+    Reading the text of an event without any raises KeyError, as indexing the event would.
+    """
+
+    __slots__ = ('event', '_text', '_lower', '_words', '_tokens')
+
+    def __init__(self, event):
+        """
+        :param event: (dict) message event
+        """
+        self.event = event
+        self._text = None
+        self._lower = None
+        self._words = None
+        self._tokens = None
+
+    @property
+    def text(self):
+        """
+        :return: (str) original message text
+        """
+        if self._text is None:
+            self._text = self.event['text']
+        return self._text
+
+    @property
+    def lower(self):
+        """
+        :return: (str) lowercase message text
+        """
+        if self._lower is None:
+            self._lower = self.text.lower()
+        return self._lower
 
-    for ch in string.punctuation:
-        s = s.strip(ch)
+    @property
+    def words(self):
+        """
+        :return: (list) lowercase text split on whitespace
+        """
+        if self._words is None:
+            self._words = self.lower.split()
+        return self._words
 
-    return s
+    @property
+    def tokens(self):
+        """
+        :return: (list) lowercase words with punctuation stripped off the sides, except a hyphen ending a word,
+            leaving out words that were only punctuation
+        """
+        if self._tokens is None:
+            self._tokens = [token for token in map(to_token, self.words) if token]
+        return self._tokens
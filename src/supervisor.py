@@ -0,0 +1,343 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from src.cache_utils import DEFAULT_CACHE_DIR, DiskCache
+from src.misc_utils import load_homophones
+from src.slackEventHandler import SlackEventHandler
+from src.word_utils import BadWordList
+from src.worker_utils import backoff_delay
+from src import web_utils
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+def load_shared(cache_dir=None):
+    """
+    Loads the read-only data every hosted handler uses, once, in the supervisor process
+
+    :param cache_dir: (str) directory of the shared on-disk caches
+    :return: (dict) homophones, bad_words, bad_words_version, bad_words_fetched, bad_words_path and gif_cache
+    """
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    web_utils.set_cache_dir(cache_dir)
+
+    bad_words = BadWordList(snapshot_path=os.path.join(cache_dir, 'bad_words.json'))
+    if not bad_words.load_snapshot():
+        try:
+            bad_words.refresh()
+        except Exception as e:
+            logger.error("Could not download bad words: {e}".format(e=e))
+
+    return {
+        'cache_dir': cache_dir,
+        'homophones': load_homophones(),
+        'bad_words': sorted(bad_words.words),
+        'bad_words_version': bad_words.version,
+        'bad_words_fetched': bad_words.fetched,
+        'bad_words_path': bad_words.snapshot_path,
+        'gif_cache': DiskCache(os.path.join(cache_dir, 'giphy'))
+    }
+
+
+class WorkspaceRunner:
+    """
+    Runs one workspace's SlackEventHandler on a thread of a worker process, creating a new handler with backoff
+    whenever the current one fails or disconnects
+    """
+
+    def __init__(self, workspace, shared, bad_words, backoff=1.0, max_backoff=300.0, stable_after=600.0):
+        """
+        :param workspace: (dict) name, token and any other SlackEventHandler arguments
+        :param shared: (dict) result of load_shared
+        :param bad_words: (BadWordList) list shared by every handler of the process
+        :param backoff: (float) seconds to wait after the first failure
+        :param max_backoff: (float) cap on the wait between restarts
+        :param stable_after: (float) seconds a handler has to run before its failure count is reset
+        """
+        self.name = workspace['name']
+        self.workspace = workspace
+        self.shared = shared
+        self.bad_words = bad_words
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.handler = None
+        self.status = 'starting'
+        self.restarts = 0
+        self.failures = 0
+        self.last_error = None
+        self._thread = None
+
+    def make_handler(self):
+        """
+        :return: SlackEventHandler for the workspace, using the shared homophones, bad words and gif cache
+        """
+        kwargs = dict((k, self.workspace[k]) for k in self.workspace if k not in ('name', 'token', 'token_env'))
+        kwargs.setdefault('init_homophones', self.shared['homophones'])
+        kwargs.setdefault('bad_words', self.bad_words)
+        kwargs.setdefault('gif_cache', self.shared['gif_cache'])
+        return SlackEventHandler(self.workspace['token'], **kwargs)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='workspace-{n}'.format(n=self.name))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            started = time.time()
+            try:
+                self.handler = self.make_handler()
+                self.status = 'running'
+                self.handler.begin()
+                self.last_error = 'disconnected'
+                logger.error("Workspace {n} disconnected.".format(n=self.name))
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error("Workspace {n} failed: {e}".format(n=self.name, e=e))
+
+            if time.time() - started >= self.stable_after:
+                self.failures = 0
+            self.failures += 1
+            self.restarts += 1
+            self.status = 'restarting'
+            time.sleep(backoff_delay(self.failures, self.backoff, self.max_backoff))
+
+    def get_stats(self):
+        """
+        :return: (dict) status, restarts, last_error, and the current handler's throughput, outbound queue stats,
+            metrics and utility pool stats
+        """
+        stats = {'status': self.status, 'restarts': self.restarts, 'last_error': self.last_error}
+        handler = self.handler
+        if handler is not None:
+            stats['throughput'] = handler.get_throughput()
+            stats['outbound'] = handler.outbound.get_stats()
+            stats['metrics'] = handler.get_metrics()
+            if handler.io is not None:
+                stats['io'] = handler.io.get_stats()
+        return stats
+
+
+def run_worker(worker_id, workspaces, shared, stats_queue, stats_interval=60.0, backoff=1.0, max_backoff=300.0,
+               stable_after=600.0):
+    """
+    Entry point of a worker process. Hosts each of its workspaces on a thread and reports their stats to the
+    supervisor every stats_interval seconds
+
+    :param worker_id: (int) index of the worker
+    :param workspaces: (list) workspaces hosted by this worker
+    :param shared: (dict) result of load_shared
+    :param stats_queue: (multiprocessing.Queue) where stats are reported
+    :param stats_interval: (float) seconds between stats reports
+    :param backoff: (float) seconds to wait after the first failure of a workspace
+    :param max_backoff: (float) cap on the wait between restarts of a workspace
+    :param stable_after: (float) seconds a handler has to run before its failure count is reset
+    :return: None
+    """
+    # one bad word list per process; its background refresh keeps the shared snapshot up to date
+    bad_words = BadWordList(snapshot_path=shared['bad_words_path'])
+    bad_words.swap(shared['bad_words'], shared['bad_words_version'], shared['bad_words_fetched'])
+    web_utils.set_cache_dir(shared['cache_dir'])
+
+    runners = [WorkspaceRunner(workspace, shared, bad_words, backoff, max_backoff, stable_after)
+               for workspace in workspaces]
+    for runner in runners:
+        runner.start()
+
+    while True:
+        time.sleep(stats_interval)
+        stats_queue.put((worker_id, dict((runner.name, runner.get_stats()) for runner in runners)))
+
+
+class Supervisor:
+    """
+    Hosts many workspace handlers across a pool of worker processes.
+    Read-only data (homophones and bad words) is loaded once here and handed to every worker, and the Giphy and
+    Genius caches live in a shared cache directory. Workers that die are restarted with exponential backoff.
+    """
+
+    def __init__(self, workspaces, processes=None, cache_dir=None, stats_interval=60.0, report_interval=300.0,
+                 backoff=1.0, max_backoff=300.0, stable_after=600.0):
+        """
+        :param workspaces: (list) dicts with a unique name, a token, and any other SlackEventHandler arguments
+        :param processes: (int) number of worker processes; defaults to one per CPU, at most one per workspace
+        :param cache_dir: (str) directory of the shared on-disk caches
+        :param stats_interval: (float) seconds between stats reports from the workers
+        :param report_interval: (float) seconds between logged aggregate reports; None to disable
+        :param backoff: (float) seconds to wait after the first failure of a worker or workspace
+        :param max_backoff: (float) cap on the wait between restarts
+        :param stable_after: (float) seconds a worker has to run before its failure count is reset
+        """
+        names = [workspace['name'] for workspace in workspaces]
+        if len(set(names)) != len(names):
+            raise ValueError("Workspace names must be unique.")
+
+        self.workspaces = workspaces
+        self.processes = max(min(processes or multiprocessing.cpu_count(), len(workspaces)), 1)
+        self.cache_dir = cache_dir
+        self.stats_interval = stats_interval
+        self.report_interval = report_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+
+        # fork where available, so workers inherit the parent's imports and shared data instead of repeating them
+        methods = multiprocessing.get_all_start_methods()
+        self._context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        self.stats_queue = self._context.Queue()
+        self.shared = None
+        self.stats = {}
+        self.workers = []
+
+    def assign(self):
+        """
+        :return: (list) workspaces of each worker, spread round robin
+        """
+        return [self.workspaces[i::self.processes] for i in range(self.processes)]
+
+    def start_worker(self, worker):
+        """
+        :param worker: (dict) worker state from self.workers
+        :return: None
+        """
+        worker['process'] = self._context.Process(
+            target=run_worker, name='workspace-worker-{i}'.format(i=worker['id']),
+            args=(worker['id'], worker['workspaces'], self.shared, self.stats_queue, self.stats_interval,
+                  self.backoff, self.max_backoff, self.stable_after))
+        worker['process'].daemon = True
+        worker['process'].start()
+        worker['started'] = time.time()
+        worker['next_start'] = None
+        logger.debug("Started worker {i} for {w}.".format(
+            i=worker['id'], w=', '.join(workspace['name'] for workspace in worker['workspaces'])))
+
+    def start(self):
+        """
+        Loads the shared data and starts every worker
+        :return: None
+        """
+        self.shared = load_shared(self.cache_dir)
+        # imported once here, so the forked workers share the modules instead of each importing them
+        flags = {}
+        for workspace in self.workspaces:
+            workspace_flags = dict(workspace.get('handler_flags') or {})
+            workspace_flags.update((key, workspace[key]) for key in workspace if key.endswith('_flg'))
+            for flg in workspace_flags:
+                flags[flg] = flags.get(flg) or workspace_flags[flg]
+        SlackEventHandler.load_dependencies(flags)
+        self.workers = [{'id': i, 'workspaces': workspaces, 'process': None, 'started': None, 'next_start': None,
+                         'failures': 0, 'restarts': 0}
+                        for i, workspaces in enumerate(self.assign())]
+        for worker in self.workers:
+            self.start_worker(worker)
+
+    def check_workers(self):
+        """
+        Schedules a restart for each worker that died, and restarts the ones whose backoff has passed
+        :return: None
+        """
+        now = time.time()
+        for worker in self.workers:
+            process = worker['process']
+            if worker['next_start'] is None and not process.is_alive():
+                if now - worker['started'] >= self.stable_after:
+                    worker['failures'] = 0
+                worker['failures'] += 1
+                delay = backoff_delay(worker['failures'], self.backoff, self.max_backoff)
+                worker['next_start'] = now + delay
+                logger.error("Worker {i} exited with code {c}. Restarting in {d:.1f}s.".format(
+                    i=worker['id'], c=process.exitcode, d=delay))
+                for workspace in worker['workspaces']:
+                    self.stats.setdefault(workspace['name'], {})['status'] = 'worker down'
+            if worker['next_start'] is not None and now >= worker['next_start']:
+                worker['restarts'] += 1
+                self.start_worker(worker)
+
+    def collect_stats(self, timeout=0.0):
+        """
+        Drains the stats reported by the workers
+        :param timeout: (float) seconds to wait for the first report
+        :return: (int) number of reports received
+        """
+        received = 0
+        while True:
+            try:
+                worker_id, stats = self.stats_queue.get(timeout=timeout) if timeout else \
+                    self.stats_queue.get_nowait()
+            except queue.Empty:
+                return received
+            for name in stats:
+                stats[name]['worker'] = worker_id
+                stats[name]['worker_restarts'] = self.workers[worker_id]['restarts']
+                self.stats[name] = stats[name]
+            received += 1
+            timeout = 0.0
+
+    def get_stats(self):
+        """
+        :return: (dict) latest stats reported for each workspace
+        """
+        return dict(self.stats)
+
+    def format_stats(self):
+        """
+        :return: (str) one line per workspace with its worker, status, restarts, events, API calls and sends
+        """
+        lines = ["{n:<20} {w:>6} {s:<12} {r:>8} {e:>8} {eps:>8} {a:>8} {m:>8} {q:>6}".format(
+            n='workspace', w='worker', s='status', r='restarts', e='events', eps='ev/s', a='api', m='sent',
+            q='queued')]
+        for workspace in self.workspaces:
+            name = workspace['name']
+            stats = self.stats.get(name, {})
+            throughput = stats.get('throughput', {})
+            metrics = stats.get('metrics', {})
+            api_calls = sum(metrics[key]['count'] for key in metrics if key.startswith('api.'))
+            lines.append("{n:<20} {w:>6} {s:<12} {r:>8} {e:>8} {eps:>8.2f} {a:>8} {m:>8} {q:>6}".format(
+                n=name, w=stats.get('worker', '-'), s=stats.get('status', 'starting'),
+                r=stats.get('restarts', 0) + stats.get('worker_restarts', 0), e=throughput.get('events', 0),
+                eps=throughput.get('events_per_sec', 0.0), a=api_calls,
+                m=metrics.get('send', {}).get('count', 0), q=stats.get('outbound', {}).get('depth', 0)))
+        return '\n'.join(lines)
+
+    def run(self, length=-1, poll_interval=1.0):
+        """
+        Starts the workers and supervises them until length seconds have passed
+
+        :param length: (int) Number of seconds to continue supervising; -1 if should not end
+        :param poll_interval: (float) seconds between checks of the workers
+        :return: None
+        """
+        self.start()
+        start_time = time.time()
+        next_report = start_time + self.report_interval if self.report_interval else None
+        try:
+            while time.time() <= start_time + length or length == -1:
+                self.collect_stats(timeout=poll_interval)
+                self.check_workers()
+                if next_report is not None and time.time() >= next_report:
+                    logger.info('\n' + self.format_stats())
+                    next_report = time.time() + self.report_interval
+        except KeyboardInterrupt:
+            logger.debug("Stopping supervisor.")
+            raise
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Terminates every worker
+        :return: None
+        """
+        for worker in self.workers:
+            if worker['process'] is not None and worker['process'].is_alive():
+                worker['process'].terminate()
+        for worker in self.workers:
+            if worker['process'] is not None:
+                worker['process'].join()
@@ -1,35 +1,227 @@
-import requests
 from src import exceptions
+from src.cache_utils import DiskCache, TTLCache, DEFAULT_CACHE_DIR
 import logging
-from lxml import html
+import os
+import threading
+import time
 import re
+from urllib.parse import urlparse
 
 logger = logging.getLogger()
 logging.basicConfig()
 logger.setLevel(logging.DEBUG)
 
+GENIUS_URL = 'https://genius.com/'
+TOP_SONGS_TTL = 6 * 60 * 60
+SONG_TTL = 30 * 24 * 60 * 60
 
-def get_request(url):
+# HTTP client settings, see configure()
+http_settings = {
+    'connect_timeout': 3.05,
+    'read_timeout': 15,
+    'retries': 3,
+    'backoff_factor': 0.5,
+    'pool_size': 10
+}
+_session = None
+_lock = threading.Lock()
+# last good response per URL, replayed when the server answers a conditional request with 304
+_validated = TTLCache(max_size=64)
+host_stats = {}
+# requests and lxml are imported on first use, so importing web_utils does not load them
+
+# Genius results are cached on disk so a restart, or a slow site, does not block sing_to_me
+genius_cache = DiskCache(os.path.join(DEFAULT_CACHE_DIR, 'genius'))
+
+
+def set_cache_dir(path):
+    """
+    Moves the on-disk Genius cache
+
+    :param path: (str) directory the cache files are written to
+    :return: None
+    """
+    genius_cache.path = os.path.join(path, 'genius')
+
+
+def cached(key, ttl, fetch):
+    """
+    Returns a cached value, calling fetch to refresh it once it has expired.
+    If the refresh fails, the expired value is returned instead when there is one.
+
+    :param key: (str) cache key
+    :param ttl: (float) seconds a fetched value stays fresh
+    :param fetch: callable returning a JSON-serialisable value
+    :return: cached or freshly fetched value
+    """
+    value = genius_cache.get(key)
+    if value is not None:
+        return value
+
+    try:
+        value = fetch()
+    except Exception:
+        stale = genius_cache.get(key, allow_expired=True)
+        if stale is None:
+            raise
+        logger.error("Could not refresh {k}. Using expired copy.".format(k=key))
+        return stale
+
+    genius_cache.set(key, value, ttl=ttl)
+    return value
+
+
+def configure(**settings):
+    """
+    Changes the HTTP client settings. The shared session is rebuilt on the next request.
+
+    :param settings: any of connect_timeout, read_timeout (seconds), retries (int), backoff_factor (float)
+        and pool_size (connections kept per host)
+    :return: None
+    """
+    global _session
+    for setting in settings:
+        if setting not in http_settings:
+            raise KeyError("Unknown HTTP setting {s}".format(s=setting))
+    with _lock:
+        http_settings.update(settings)
+        _session = None
+
+
+def get_session():
+    """
+    Returns the connection-pooled session shared by every request in web_utils.
+    Connection errors and 429/5xx responses are retried with exponential backoff.
+
+    :return: requests.Session
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(total=http_settings['retries'],
+                          backoff_factor=http_settings['backoff_factor'],
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=http_settings['pool_size'],
+                                  pool_maxsize=http_settings['pool_size'],
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def record_request(url, seconds, status=None):
+    """
+    Adds a request to the latency stats for its host
+
+    :param url: URL requested
+    :param seconds: (float) time taken by the request
+    :param status: (int) status code received, or None if the request failed
+    :return: None
+    """
+    host = urlparse(url).netloc
+    with _lock:
+        stats = host_stats.get(host)
+        if stats is None:
+            stats = host_stats[host] = {'requests': 0, 'errors': 0, 'not_modified': 0,
+                                        'total_seconds': 0.0, 'max_seconds': 0.0}
+        stats['requests'] += 1
+        stats['total_seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        if status is None or status >= 400:
+            stats['errors'] += 1
+        elif status == 304:
+            stats['not_modified'] += 1
+
+
+def get_host_stats():
+    """
+    Returns request count, errors, 304s and latency for every host requested so far
+    :return: dict of host to stats
     """
-    Passes a url to a get request. Just a little error handling
+    with _lock:
+        stats = dict((host, dict(host_stats[host])) for host in host_stats)
+    for host in stats:
+        stats[host]['avg_seconds'] = stats[host]['total_seconds'] / stats[host]['requests']
+    return stats
+
+
+def get_request(url, conditional=True):
+    """
+    Passes a url to a get request on the shared session, with timeouts, retries and a little error handling.
+    If the URL was fetched before, the request is made conditional (ETag/If-Modified-Since) and a 304
+    answer returns the earlier response.
 
     :param url: URL to request
+    :param conditional: (bool) if False, always fetch the full response
     :return: Request object returned from get method
+    :raises BadStatusCodeException: if the final status code is not 200
+    :raises RequestFailedException: on timeouts and connection errors
     """
+    import requests
+
+    headers = {}
+    with _lock:
+        previous = _validated.get(url) if conditional else None
+    if previous is not None:
+        if previous.headers.get('ETag'):
+            headers['If-None-Match'] = previous.headers['ETag']
+        if previous.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = previous.headers['Last-Modified']
+
+    start = time.time()
+    try:
+        r = get_session().get(url, headers=headers,
+                              timeout=(http_settings['connect_timeout'], http_settings['read_timeout']))
+    except requests.RequestException as e:
+        record_request(url, time.time() - start)
+        error = exceptions.RequestFailedException(url, e)
+        logger.error(error.message)
+        raise error
+    record_request(url, time.time() - start, r.status_code)
+
     try:
-        r = requests.get(url)
+        if r.status_code == 304 and previous is not None:
+            return previous
         if r.status_code != 200:
             raise exceptions.BadStatusCodeException(url, r.status_code)
 
+        if r.headers.get('ETag') or r.headers.get('Last-Modified'):
+            with _lock:
+                _validated.set(url, r)
         return r
     except exceptions.BadStatusCodeException as e:
         logger.error(e.message)
+        raise
+
 
+def parse_html(text):
+    """
+    :param text: (str) HTML page
+    :return: lxml element for the page
+    """
+    from lxml import html
+    return html.fromstring(text)
+
+
+def get_top_songs(use_cache=True):
+    """
+    Get the URLs of the popular songs listed on the Genius homepage
+    :param use_cache: (bool) if True, serve the list from the on-disk cache while it is fresh
+    :return: list of song URLs
+    """
+    if use_cache:
+        return cached('top_songs', TOP_SONGS_TTL, lambda: get_top_songs(use_cache=False))
 
-def get_top_songs():
     songs = []
-    r = get_request('https://genius.com/')
-    h = html.fromstring(r.text)
+    r = get_request(GENIUS_URL)
+    h = parse_html(r.text)
     table = h.find_class('column_layout-column_span column_layout-column_span--full')[0]
     for x in table.iter('a'):
         songs.append(x.get('href'))
@@ -37,13 +229,28 @@ def get_top_songs():
     return songs
 
 
+def get_song(url, use_cache=True):
+    """
+    Get the artist, title and lyrics of a song from a Genius lyrics URL
+    :param url: Genius lyrics URL
+    :param use_cache: (bool) if True, serve the song from the on-disk cache while it is fresh
+    :return: dict with url, artist, song and lyrics
+    """
+    if use_cache:
+        return cached('song:' + url, SONG_TTL, lambda: get_song(url, use_cache=False))
+
+    r = get_request(url)
+    artist, song = get_artist_song(r)
+    return {'url': url, 'artist': artist, 'song': song, 'lyrics': get_lyrics(r)}
+
+
 def get_artist_song(r):
     """
     Get the name of an artist and song from a Genius lyrics URL
     :param r: Request object for Genius URL
     :return: two fields: artist, song
     """
-    h = html.fromstring(r.text)
+    h = parse_html(r.text)
     song = h.find_class('header_with_cover_art-primary_info-title')[0].text.title()
     artist = h.find_class('header_with_cover_art-primary_info-primary_artist')[0].text.title()
     return artist, song
@@ -56,7 +263,7 @@ def get_lyrics(r):
     :return: list object containing lines of song
     """
     o_lyrics = []
-    h = html.fromstring(r.text)
+    h = parse_html(r.text)
     lyrics = h.find_class('lyrics')[0]
     add_line = True
     for x in lyrics.iter('p'):
@@ -0,0 +1,378 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from src.cache_utils import DEFAULT_CACHE_DIR
+from src.match_utils import AhoCorasick
+from src import web_utils
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+# seed list, a copy of http://www.bannedwordlist.com/lists/swearWords.xml; used until a snapshot has been saved, so
+# clean_your_mouth_with_soap works on a first start without network access
+DEFAULT_BAD_WORDS = [
+    'anal', 'anus', 'arse', 'ass', 'ballsack', 'balls', 'bastard', 'bitch', 'biatch', 'bloody', 'blowjob',
+    'blow job', 'bollock', 'bollok', 'boner', 'boob', 'bugger', 'bum', 'butt', 'buttplug', 'clitoris', 'cock',
+    'coon', 'crap', 'cunt', 'damn', 'dick', 'dildo', 'dyke', 'fag', 'feck', 'fellate', 'fellatio', 'felching',
+    'fuck', 'f u c k', 'fudgepacker', 'fudge packer', 'flange', 'Goddamn', 'God damn', 'hell', 'homo', 'jerk',
+    'jizz', 'knobend', 'knob end', 'labia', 'lmao', 'lmfao', 'muff', 'nigger', 'nigga', 'omg', 'penis', 'piss',
+    'poop', 'prick', 'pube', 'pussy', 'queer', 'scrotum', 'sex', 'shit', 's hit', 'sh1t', 'slut', 'smegma',
+    'spunk', 'tit', 'tosser', 'turd', 'twat', 'vagina', 'wank', 'whore', 'wtf'
+]
+
+# look-alike characters read as letters inside words that contain at least one letter, i.e. "h3ck", "$hoot"
+LEET = {'0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '8': 'b', '9': 'g',
+        '@': 'a', '$': 's', '!': 'i', '|': 'i', '+': 't'}
+# characters dropped from inside words, i.e. "d.a.r.n" or "d_a_r_n"
+SEPARATORS = ".-_*~`\"^,:;"
+# punctuation stripped from the ends of words; leet characters are only stripped where they cannot start a word
+LEADING_PUNCTUATION = '.,?;:()[]{}<>"\'`'
+TRAILING_PUNCTUATION = '.,!?;:()[]{}<>"\'`'
+
+# group 1 is the word without its leading and trailing punctuation
+WORD = re.compile(r'(?<!\S)[{l}]*(\S*?)[{t}]*(?!\S)'.format(l=re.escape(LEADING_PUNCTUATION),
+                                                           t=re.escape(TRAILING_PUNCTUATION)))
+# three or more single letter words in a row, i.e. "d a r n", in words joined by single spaces
+SPELLED_OUT = re.compile(r'(?<![^ ])[^ ](?: [^ ]){2,}(?![^ ])')
+LETTER = re.compile(r'[^\W\d_]')
+LEET_CHARACTER = re.compile('[{c}]'.format(c=re.escape(''.join(LEET))))
+LETTERLESS_WORD = re.compile(r'(?<!\S)(?:(?![^\W\d_])\S)+(?!\S)')
+# apostrophes dropped like separators: all but those starting a contraction, so "he'll" does not read as "hell"
+APOSTROPHE = re.compile(r"'(?!(?:ll|re|ve|s|t|d|m)(?:\s|$))")
+# every character followed by the same one; removing them collapses runs of repeated letters
+REPEATS = re.compile(r'(.)(?=\1)')
+_LEET_TABLE = str.maketrans(''.join(LEET), ''.join(LEET.values()), SEPARATORS)
+_SEPARATOR_TABLE = str.maketrans('', '', SEPARATORS)
+
+
+def _lower(text):
+    lower = text.lower()
+    if len(lower) != len(text):
+        # a few characters lowercase to more than one, which would shift every offset after them
+        lower = ''.join(ch.lower()[0] for ch in text)
+    return lower
+
+
+def _words(lower):
+    """
+    :param lower: (str) lowercased text
+    :return: (list) spans of the words of the text, each a list of (start, end) pieces; runs of three or more single
+        letter words are read as one word
+    """
+    spans = [match.span(1) for match in WORD.finditer(lower) if match.end(1) > match.start(1)]
+    words = []
+    i = 0
+    while i < len(spans):
+        j = i
+        while j < len(spans) and spans[j][1] - spans[j][0] == 1:
+            j += 1
+        if j - i >= 3:
+            words.append(spans[i:j])
+            i = j
+        else:
+            words.append(spans[i:i + 1])
+            i += 1
+    return words
+
+
+def normalise(text):
+    """
+    Normalises text for profanity matching: lowercases, strips punctuation off the ends of words, reads leet
+    characters as letters, drops separators inside words, joins runs of single letter words and collapses repeated
+    letters. Works on the whole text at once with regular expressions and str.translate.
+
+    :param text: (str) text to normalise
+    :return: (str) normalised words joined and padded with spaces
+    """
+    words = (word.lstrip(LEADING_PUNCTUATION).rstrip(TRAILING_PUNCTUATION) for word in _lower(text).split())
+    words = ' '.join(word for word in words if word)
+    words = SPELLED_OUT.sub(lambda match: match.group().replace(' ', ''), words)
+    if "'" in words:
+        words = APOSTROPHE.sub('', words)
+    if LEET_CHARACTER.search(words) is None or LETTERLESS_WORD.search(words) is None:
+        words = words.translate(_LEET_TABLE)
+    else:
+        # numbers and the like are not leet
+        words = ' '.join(word.translate(_LEET_TABLE if LETTER.search(word) else _SEPARATOR_TABLE)
+                         for word in words.split(' '))
+    # collapsing repeats also squeezes out the double spaces left by words made only of separators
+    return REPEATS.sub('', ' ' + words + ' ')
+
+
+def normalise_offsets(text):
+    """
+    Normalises text as normalise() does, one character at a time, keeping track of where each character came from
+
+    :param text: (str) text to normalise
+    :return: normalised text, then for each of its characters the number of repeated letters it stands for, and its
+        start and end offsets in the original text (-1 for the spaces)
+    """
+    lower = _lower(text)
+    chars, runs, starts, ends = [' '], [0], [-1], [-1]
+    for pieces in _words(lower):
+        leet = any(LETTER.search(lower, start, end) for start, end in pieces)
+        first = len(chars)
+        for start, end in pieces:
+            for k in range(start, end):
+                ch = lower[k]
+                if leet:
+                    ch = LEET.get(ch, ch)
+                if ch in SEPARATORS or (ch == "'" and APOSTROPHE.match(lower, k, end)):
+                    continue
+                if len(chars) > first and chars[-1] == ch:
+                    runs[-1] += 1
+                    ends[-1] = k + 1
+                else:
+                    chars.append(ch)
+                    runs.append(1)
+                    starts.append(k)
+                    ends.append(k + 1)
+        if len(chars) > first:
+            chars.append(' ')
+            runs.append(0)
+            starts.append(-1)
+            ends.append(-1)
+    return ''.join(chars), runs, starts, ends
+
+
+class ProfanityMatcher:
+    """
+    Finds bad words in a message, including obfuscated variants such as "D.A.R.N", "h3ck" or "daaarn".
+    Words and messages go through the same normalise() table, and every normalised word is matched in a single
+    pass by an Aho-Corasick automaton over the space padded text, so only whole words match.
+    Repeated letters are collapsed on both sides and the repeat counts checked afterwards, so a word with a double
+    letter still needs at least two of that letter in the message. Messages are first checked with a set lookup on
+    their normalised words, and only run through the automaton when one of them is a bad word, or when the list has
+    phrases; offsets and repeat counts are only worked out for messages with a candidate match.
+    """
+
+    def __init__(self, words=()):
+        """
+        :param words: iterable of bad words
+        """
+        self.automaton = AhoCorasick()
+        self.runs = {}
+        # normalised single words to how many bad words they stand for, and the number of multi-word phrases
+        self.keys = {}
+        self.phrases = 0
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len(self.runs)
+
+    def add(self, word):
+        """
+        :param word: (str) bad word, or phrase
+        :return: (bool) True if the word was added
+        """
+        chars, runs, _, _ = normalise_offsets(word)
+        if chars == ' ' or word in self.runs:
+            return False
+        self.runs[word] = runs[1:-1]
+        self.automaton.add(chars, word)
+        key = chars[1:-1]
+        if ' ' in key:
+            self.phrases += 1
+        else:
+            self.keys[key] = self.keys.get(key, 0) + 1
+        return True
+
+    def remove(self, word):
+        """
+        :param word: (str) bad word, or phrase
+        :return: (bool) True if the word was removed
+        """
+        if self.runs.pop(word, None) is None:
+            return False
+        chars = normalise(word)
+        self.automaton.remove(chars, word)
+        key = chars[1:-1]
+        if ' ' in key:
+            self.phrases -= 1
+        elif self.keys[key] > 1:
+            self.keys[key] -= 1
+        else:
+            del self.keys[key]
+        return True
+
+    def iter_matches(self, text):
+        """
+        Finds every bad word in the text
+
+        :param text: (str) message text
+        :return: generator of (start, end, word), where text[start:end] is the span of the message that matched
+        """
+        normalised = normalise(text)
+        if not self.phrases and self.keys.keys().isdisjoint(normalised.split()):
+            return
+        candidates = list(self.automaton.iter_matches(normalised))
+        if not candidates:
+            return
+        _, runs, starts, ends = normalise_offsets(text)
+        for start, end, word in candidates:
+            # skip the padding spaces, then check the message repeats each letter at least as often as the word
+            expected = self.runs[word]
+            if all(runs[start + 1 + i] >= n for i, n in enumerate(expected)):
+                yield starts[start + 1], ends[end - 2], word
+
+    def find_all(self, text):
+        """
+        :param text: (str) message text
+        :return: (set) bad words found in the text
+        """
+        return set(word for _, _, word in self.iter_matches(text))
+
+    def search(self, text):
+        """
+        :param text: (str) message text
+        :return: (tuple) start, end and word of the first bad word found, or None
+        """
+        return next(self.iter_matches(text), None)
+
+
+class BadWordList:
+    """
+    Set of bad words for clean_your_mouth_with_soap, loaded from a versioned local snapshot, or from
+    DEFAULT_BAD_WORDS when there is none yet.
+    A background refresh downloads the list again and swaps in the new set when its version changes,
+    so loading the list never waits on the network.
+    """
+
+    def __init__(self, snapshot_path=None, refresh_interval=24 * 60 * 60, retry_interval=15 * 60):
+        """
+        :param snapshot_path: (str) JSON file the list is saved to and loaded from
+        :param refresh_interval: (float) seconds between downloads of the list
+        :param retry_interval: (float) seconds to wait after a failed download
+        """
+        self.snapshot_path = snapshot_path or os.path.join(DEFAULT_CACHE_DIR, 'bad_words.json')
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.words = frozenset()
+        self.matcher = ProfanityMatcher()
+        self.version = None
+        self.fetched = None
+        self._thread = None
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __len__(self):
+        return len(self.words)
+
+    @staticmethod
+    def make_version(words):
+        """
+        :param words: iterable of words
+        :return: (str) content hash identifying this version of the list
+        """
+        return hashlib.sha1('\n'.join(sorted(words)).encode('utf-8')).hexdigest()
+
+    def load_snapshot(self):
+        """
+        Loads the list from the local snapshot, if there is one, and DEFAULT_BAD_WORDS otherwise.
+        The default list is never marked as fetched, so the background refresh downloads the list right away.
+
+        :return: (bool) True if a snapshot was loaded, False if the default list was used
+        """
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, ValueError):
+            logger.debug("No bad word snapshot found at {p}. Using the {n} default bad words.".format(
+                p=self.snapshot_path, n=len(DEFAULT_BAD_WORDS)))
+            self.swap(DEFAULT_BAD_WORDS)
+            return False
+
+        self.swap(snapshot['words'], snapshot.get('version'), snapshot.get('fetched'))
+        logger.debug("Loaded {n} bad words from snapshot {v}.".format(n=len(self.words), v=self.version))
+        return True
+
+    def save_snapshot(self):
+        """
+        Writes the current list to the local snapshot, replacing the file atomically
+        :return: None
+        """
+        snapshot = {'version': self.version, 'fetched': self.fetched, 'words': sorted(self.words)}
+        directory = os.path.dirname(self.snapshot_path)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory or None, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, self.snapshot_path)
+        except (IOError, OSError) as e:
+            logger.error("Could not save bad word snapshot: {e}".format(e=e))
+
+    def swap(self, words, version=None, fetched=None):
+        """
+        Replaces the in-memory list and its matcher, so readers see either the old or the new version
+
+        :param words: iterable of words
+        :param version: (str) version of the list; computed from the words if None
+        :param fetched: (float) time the list was downloaded
+        :return: None
+        """
+        words = frozenset(words)
+        matcher = ProfanityMatcher(words)
+        self.version = version or self.make_version(words)
+        self.fetched = fetched
+        self.words = words
+        self.matcher = matcher
+
+    def refresh(self):
+        """
+        Downloads the list and swaps it in if it differs from the current version
+
+        :return: (bool) True if a new version was swapped in
+        """
+        words = web_utils.get_bad_words()
+        if not words:
+            logger.error("Downloaded bad word list is empty. Keeping version {v}.".format(v=self.version))
+            return False
+        version = self.make_version(words)
+        changed = version != self.version
+        if changed:
+            self.swap(words, version, time.time())
+            logger.debug("Updated bad words to version {v}.".format(v=version))
+        else:
+            self.fetched = time.time()
+        self.save_snapshot()
+        return changed
+
+    def start_refresh(self):
+        """
+        Starts the background refresh, if it is not already running.
+        The first download happens right away if the snapshot is missing or older than refresh_interval.
+
+        :return: None
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='bad-word-refresh')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            age = time.time() - (self.fetched or 0)
+            if age < self.refresh_interval:
+                time.sleep(self.refresh_interval - age)
+            fetched = self.fetched
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Could not refresh bad words: {e}".format(e=e))
+            if self.fetched == fetched:
+                # the download failed or was empty
+                time.sleep(self.retry_interval)
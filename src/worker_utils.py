@@ -0,0 +1,140 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+def backoff_delay(failures, initial=1.0, maximum=300.0, jitter=0.0):
+    """
+    :param failures: (int) number of failures in a row
+    :param initial: (float) seconds to wait after the first failure
+    :param maximum: (float) cap on the wait
+    :param jitter: (float) fraction of the wait, between 0 and 1, randomly taken off so clients that failed together
+        do not all retry at the same moment
+    :return: (float) seconds to wait before the next attempt, doubling with every failure
+    """
+    if failures <= 0:
+        return 0.0
+    delay = min(initial * 2 ** (failures - 1), maximum)
+    return delay * (1 - jitter * random.random())
+
+
+class ChannelExecutor:
+    """
+    Runs work on a bounded thread pool while keeping the order of the work submitted for each channel.
+    Each channel has its own queue, drained by at most one pool thread at a time, so different channels run in
+    parallel and a single channel runs in order. New work is dropped once max_queued tasks are waiting.
+    """
+
+    def __init__(self, max_workers=4, max_queued=200):
+        """
+        :param max_workers: (int) number of pool threads
+        :param max_queued: (int) maximum number of tasks waiting across all channels
+        """
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'dropped': 0}
+        self._pool = None
+        self._queues = {}
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='io-utility')
+        return self._pool
+
+    def submit(self, channel, fn, *args):
+        """
+        Queues fn(*args) behind any work already waiting for the channel
+
+        :param channel: (str) channel the work belongs to
+        :param fn: callable to run
+        :param args: arguments for fn
+        :return: (bool) False if the queue was full and the work was dropped
+        """
+        with self._lock:
+            if self._depth >= self.max_queued:
+                self.stats['dropped'] += 1
+                logger.error("Utility queue full ({d} tasks). Dropping work for channel {c}.".format(
+                    d=self._depth, c=channel))
+                return False
+            tasks = self._queues.get(channel)
+            start = tasks is None
+            if start:
+                tasks = self._queues[channel] = deque()
+            tasks.append((fn, args))
+            self._depth += 1
+            self.stats['submitted'] += 1
+        if start:
+            self.pool.submit(self._drain, channel)
+        return True
+
+    def _drain(self, channel):
+        while True:
+            with self._lock:
+                tasks = self._queues[channel]
+                if not tasks:
+                    del self._queues[channel]
+                    if not self._queues:
+                        self._idle.notify_all()
+                    return
+                fn, args = tasks.popleft()
+                self._depth -= 1
+
+            try:
+                fn(*args)
+                failed = False
+            except Exception as e:
+                logger.error("Utility failed in channel {c}: {e}".format(c=channel, e=e))
+                failed = True
+            with self._lock:
+                self.stats['failed' if failed else 'completed'] += 1
+
+    def join(self, timeout=None):
+        """
+        Waits until every queued task has run
+
+        :param timeout: (float) seconds to wait at most; None to wait indefinitely
+        :return: (bool) True if all work finished
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            while self._queues:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def shutdown(self, wait=True):
+        """
+        Stops the pool threads once the tasks already handed to them are done. Work submitted afterwards starts a
+        new pool.
+
+        :param wait: (bool) True to block until the pool threads have exited
+        :return: None
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+    def get_stats(self):
+        """
+        :return: (dict) number of waiting tasks, number of channels with work, and submitted/completed/failed/dropped
+            counters
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats['depth'] = self._depth
+            stats['channels_busy'] = len(self._queues)
+        return stats